@@ -0,0 +1,76 @@
+from gamelog import get_log
+import pygame
+import threading
+import os
+
+IMAGES_DIR = os.path.join("data", "images")
+SOUNDS_DIR = os.path.join("data", "sounds")
+
+log = get_log("assets")
+
+
+class AssetManager(object):
+    # Every image and sound is decoded once, on first use, and shared by
+    # all screens. prefetch() can warm the cache from a background thread
+    def __init__(self, images_dir: str = IMAGES_DIR,
+                 sounds_dir: str = SOUNDS_DIR):
+        self.images_dir = images_dir
+        self.sounds_dir = sounds_dir
+        # Image name -> surface as decoded, (name, scale) -> display ready
+        self.decoded = {}
+        self.images = {}
+        self.sounds = {}
+        self.lock = threading.RLock()
+        self.prefetch_thread = None
+
+    def decode_image(self, name: str):
+        with self.lock:
+            if name not in self.decoded:
+                self.decoded[name] = pygame.image.load(
+                    os.path.join(self.images_dir, name))
+            return self.decoded[name]
+
+    def get_image(self, name: str, scale: float = 1.0):
+        # Conversion needs the display, so it is left to the main thread
+        key = (name, scale)
+        if key not in self.images:
+            image = self.decode_image(name).convert()
+            if scale != 1.0:
+                x = round(image.get_width() * scale)
+                y = round(image.get_height() * scale)
+                image = pygame.transform.smoothscale(image, (x, y))
+            self.images[key] = image
+        return self.images[key]
+
+    def get_sound(self, name: str):
+        with self.lock:
+            if name not in self.sounds:
+                self.sounds[name] = pygame.mixer.Sound(
+                    os.path.join(self.sounds_dir, name))
+            return self.sounds[name]
+
+    def prefetch(self, images=(), sounds=()):
+        if self.prefetch_thread is not None:
+            return self.prefetch_thread
+        self.prefetch_thread = threading.Thread(
+            target=self._prefetch, args=(images, sounds), daemon=True)
+        self.prefetch_thread.start()
+        return self.prefetch_thread
+
+    def _prefetch(self, images, sounds) -> None:
+        for load, names in ((self.decode_image, images),
+                            (self.get_sound, sounds)):
+            for name in names:
+                try:
+                    load(name)
+                except (OSError, pygame.error) as error:
+                    # Raised again on first use, where it can be handled
+                    if log.info_on:
+                        log.info("prefetch of %s failed: %s", name, error)
+
+    def wait(self) -> None:
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+
+
+default_assets = AssetManager()
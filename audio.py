@@ -0,0 +1,128 @@
+import pygame
+import os
+from collections import deque
+from time import perf_counter
+
+from assets import AssetManager, SOUNDS_DIR, default_assets
+from gamelog import get_log
+
+log = get_log("audio")
+
+# Streamable formats, the first one found wins
+MUSIC_EXTENSIONS = (".ogg", ".mp3", ".wav")
+# Effect category -> channels reserved for it, so one category can never
+# cut off the sounds of another
+CHANNEL_CATEGORIES = {"piece": 2, "drop": 1, "ui": 1}
+
+
+class MusicPlayer(object):
+    # Streams background music through pygame.mixer.music in small chunks
+    # instead of decoding whole tracks into memory. A missing track or an
+    # unavailable mixer just means silence
+    def __init__(self, music_dir: str = SOUNDS_DIR):
+        self.music_dir = music_dir
+        self.track = None
+
+    def find_track(self, name: str):
+        # name may come with or without an extension
+        base, ext = os.path.splitext(name)
+        for extension in (ext,) if ext else MUSIC_EXTENSIONS:
+            path = os.path.join(self.music_dir, base + extension)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def play(self, name: str, volume: float = 1.0, loops: int = -1) -> bool:
+        path = self.find_track(name)
+        if path is None or not pygame.mixer.get_init():
+            if log.warning_on:
+                log.warning("music %s not played, %s", name,
+                            "no mixer" if path else "no such track")
+            return False
+        try:
+            if path != self.track:
+                pygame.mixer.music.load(path)
+                self.track = path
+            pygame.mixer.music.set_volume(volume)
+            pygame.mixer.music.play(loops)
+        except pygame.error as error:
+            self.track = None
+            if log.warning_on:
+                log.warning("music %s failed: %s", path, error)
+            return False
+        return True
+
+    def stop(self) -> None:
+        if pygame.mixer.get_init():
+            pygame.mixer.music.stop()
+
+    def is_playing(self) -> bool:
+        return bool(pygame.mixer.get_init()) and pygame.mixer.music.get_busy()
+
+
+class AudioEngine(object):
+    # Sound effects on a mixer opened with a small buffer, each category
+    # playing on its own reserved channels
+    def __init__(self, frequency: int = 44100, buffer: int = 256,
+                 categories: dict = CHANNEL_CATEGORIES,
+                 assets: AssetManager = default_assets):
+        self.frequency = frequency
+        self.buffer = buffer
+        self.categories = categories
+        self.assets = assets
+        self.effects = {}
+        self.channels = {}
+        self.next_channel = {}
+        # Seconds spent handing sounds to the mixer, for get_latency()
+        self.trigger_times = deque(maxlen=256)
+
+    def pre_init(self) -> None:
+        # Has to run before pygame.init() or pygame.mixer.init()
+        pygame.mixer.pre_init(self.frequency, -16, 2, self.buffer)
+
+    def init(self) -> None:
+        # Reserves the first channels of the mixer, category by category
+        if not pygame.mixer.get_init():
+            if log.warning_on:
+                log.warning("mixer unavailable, sound effects are off")
+            return
+        reserved = sum(self.categories.values())
+        pygame.mixer.set_num_channels(
+            max(pygame.mixer.get_num_channels(), reserved + 4))
+        pygame.mixer.set_reserved(reserved)
+        first = 0
+        for category, count in self.categories.items():
+            self.channels[category] = [pygame.mixer.Channel(i) for i in
+                                       range(first, first + count)]
+            self.next_channel[category] = 0
+            first += count
+
+    def add_effect(self, name: str, category: str) -> None:
+        self.effects[name] = category
+
+    def play(self, name: str) -> None:
+        if not self.channels:
+            return
+        start = perf_counter()
+        sound = self.assets.get_sound(name)
+        channels = self.channels[self.effects[name]]
+        # Round robin inside the category, the oldest sound is cut first
+        index = self.next_channel[self.effects[name]]
+        self.next_channel[self.effects[name]] = (index + 1) % len(channels)
+        channels[index].play(sound)
+        self.trigger_times.append(perf_counter() - start)
+
+    def get_latency(self) -> float:
+        # Seconds from play() to the sound reaching the device: the time
+        # play() takes plus one mixer buffer at the negotiated frequency
+        if not pygame.mixer.get_init():
+            return 0.0
+        frequency = pygame.mixer.get_init()[0]
+        trigger = 0.0
+        if self.trigger_times:
+            trigger = sum(self.trigger_times) / len(self.trigger_times)
+        return trigger + self.buffer / frequency
+
+
+default_music = MusicPlayer()
+default_audio = AudioEngine()
@@ -0,0 +1,203 @@
+from core import TetrisBoard, BitboardTetrisBoard, Tetromino, Pentomino, \
+    ColorMap
+from engine import TetrisEngine, Action
+from random import Random
+from time import perf_counter
+import argparse
+
+
+def play_board(board_type, piece_type, pieces, seed):
+    rng = Random(seed)
+    board = board_type()
+    start = perf_counter()
+    for _ in range(pieces):
+        piece = piece_type((0, 0), *rng.choice(piece_type.SHAPES))
+        piece.set_coords((4, 21))
+        if board.piece_collides_tiles(piece):
+            board.reset()
+        board.new_piece(piece)
+        for _ in range(rng.randrange(4)):
+            board.rotate_curr_piece(True)
+            board.get_ghost_piece()
+        shift = rng.randrange(-5, 6)
+        for _ in range(abs(shift)):
+            board.horiz_move_curr_piece(shift > 0)
+            board.get_ghost_piece()
+        board.check_lock_delay()
+        board.hard_drop_curr_piece()
+        board.put_curr_piece()
+        board.clear_filled_rows()
+    elapsed = perf_counter() - start
+    return elapsed, [list(column) for column in board.get_tiles()]
+
+
+def bench_boards(args):
+    for piece_type in (Tetromino, Pentomino):
+        results = {}
+        for board_type in (TetrisBoard, BitboardTetrisBoard):
+            elapsed, tiles = play_board(board_type, piece_type,
+                                        args.pieces, args.seed)
+            results[board_type.__name__] = (elapsed, tiles)
+        base_time, base_tiles = results["TetrisBoard"]
+        for name, (elapsed, tiles) in results.items():
+            same = "ok" if tiles == base_tiles else "MISMATCH"
+            print(f"{piece_type.__name__:10} {name:20} "
+                  f"{elapsed * 1000:9.1f} ms  "
+                  f"{args.pieces / elapsed:9.0f} pieces/s  "
+                  f"x{base_time / elapsed:5.2f}  {same}")
+
+
+def bench_frame(args):
+    # The board work Tetris.run does every frame: lock delay check (twice),
+    # ghost computation and tile lookups for the renderers
+    rng = Random(args.seed)
+    for piece_type in (Tetromino, Pentomino):
+        board = BitboardTetrisBoard()
+        for _ in range(12):
+            piece = piece_type((0, 0), *rng.choice(piece_type.SHAPES))
+            board.new_piece(piece)
+            board.horiz_move_curr_piece(rng.random() < 0.5)
+            board.hard_drop_curr_piece()
+            board.put_curr_piece()
+            board.clear_filled_rows()
+        board.new_piece(piece_type((0, 0), *rng.choice(piece_type.SHAPES)))
+        start = perf_counter()
+        for frame in range(args.frames):
+            if frame % 15 == 0:
+                board.rotate_curr_piece(True)
+            board.check_lock_delay()
+            board.check_lock_delay()
+            ghost = board.get_ghost_piece()
+            board.get_curr_piece().get_tiles_coords()
+            ghost.get_tiles_coords()
+        elapsed = perf_counter() - start
+        print(f"{piece_type.__name__:10} "
+              f"{elapsed / args.frames * 1e6:8.1f} us/frame")
+
+
+def bench_engine(args):
+    # Headless games with random inputs, many times faster than real time
+    rng = Random(args.seed)
+    actions = (Action.LEFT, Action.RIGHT, Action.ROTATE_CW,
+               Action.SOFT_DROP, Action.HARD_DROP)
+    for piece_type in (Tetromino, Pentomino):
+        engine = TetrisEngine(piece_type)
+        steps = 0
+        start = perf_counter()
+        while steps < args.steps:
+            if engine.game_over:
+                engine.reset()
+            engine.step((rng.choice(actions),) if rng.random() < 0.3 else ())
+            steps += 1
+        elapsed = perf_counter() - start
+        print(f"{piece_type.__name__:10} {steps / elapsed:10.0f} steps/s  "
+              f"x{steps / elapsed / engine.tick_rate:6.0f} real time")
+
+
+def bench_vector(args):
+    # numpy is only needed for the batched simulator
+    from vector_engine import VectorEngine
+    for piece_type in (Tetromino, Pentomino):
+        for boards in args.boards:
+            engine = VectorEngine(piece_type, boards, seed=args.seed)
+            steps = max(50, min(args.max_steps, args.work // boards))
+            start = perf_counter()
+            for _ in range(steps):
+                engine.step(engine.random_actions())
+                engine.reset_boards(engine.game_over)
+            elapsed = perf_counter() - start
+            print(f"{piece_type.__name__:10} N={boards:<6} "
+                  f"{boards * steps / elapsed:12.0f} boards*steps/s")
+
+
+def bench_viewport(args):
+    # Renders a partly filled board that is taller than the screen, drawn
+    # bottom aligned like the game does, with and without culling
+    import os
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    from render import PygameTileField
+    pygame.init()
+    screen = pygame.display.set_mode((700, 700))
+    rng = Random(args.seed)
+    for height in args.heights:
+        board = TetrisBoard(height=height)
+        for y in range(height // 2, height):
+            for x in range(board.width):
+                if rng.random() < 0.5:
+                    board.set_tile((x, y), ColorMap.RED)
+        top = screen.get_height() - height * args.tile
+        results = []
+        for viewport in (None, screen.get_rect()):
+            renderer = PygameTileField((150, top), board,
+                                       (args.tile, args.tile), ColorMap.CLEAR,
+                                       viewport=viewport, margin=args.margin)
+            start = perf_counter()
+            for _ in range(args.frames):
+                renderer.render(screen)
+            results.append((perf_counter() - start) / args.frames)
+        print(f"{height:5} rows  all {results[0] * 1000:8.3f} ms  "
+              f"visible {results[1] * 1000:8.3f} ms  "
+              f"x{results[0] / results[1]:6.2f}")
+    pygame.quit()
+
+
+def bench_startup(args):
+    # Cold start: building the menu and every screen behind it, up to the
+    # first menu frame, then how long the prefetch thread keeps going
+    import os
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    start = perf_counter()
+    import pygame
+    pygame.init()
+    screen = pygame.display.set_mode((700, 700))
+    import main as game
+    from assets import default_assets
+    menu = game.Menu(screen, prefetch=False)
+    menu.render()
+    first_frame = perf_counter() - start
+    default_assets.prefetch(game.GAME_IMAGES, game.GAME_SOUNDS)
+    default_assets.wait()
+    print(f"first menu frame {first_frame * 1000:8.1f} ms  "
+          f"prefetch done {(perf_counter() - start) * 1000:8.1f} ms")
+    pygame.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+    boards = subparsers.add_parser("boards")
+    boards.add_argument("--pieces", type=int, default=2000)
+    boards.add_argument("--seed", type=int, default=0)
+    boards.set_defaults(func=bench_boards)
+    frame = subparsers.add_parser("frame")
+    frame.add_argument("--frames", type=int, default=20000)
+    frame.add_argument("--seed", type=int, default=0)
+    frame.set_defaults(func=bench_frame)
+    engine = subparsers.add_parser("engine")
+    engine.add_argument("--steps", type=int, default=100000)
+    engine.add_argument("--seed", type=int, default=0)
+    engine.set_defaults(func=bench_engine)
+    vector = subparsers.add_parser("vector")
+    vector.add_argument("--boards", type=int, nargs="+",
+                        default=[1, 64, 1024, 16384])
+    vector.add_argument("--work", type=int, default=2000000)
+    vector.add_argument("--max-steps", type=int, default=2000)
+    vector.add_argument("--seed", type=int, default=0)
+    vector.set_defaults(func=bench_vector)
+    viewport = subparsers.add_parser("viewport")
+    viewport.add_argument("--heights", type=int, nargs="+",
+                          default=[40, 100, 400, 1000])
+    viewport.add_argument("--tile", type=int, default=40)
+    viewport.add_argument("--margin", type=int, default=2)
+    viewport.add_argument("--frames", type=int, default=200)
+    viewport.add_argument("--seed", type=int, default=0)
+    viewport.set_defaults(func=bench_viewport)
+    startup = subparsers.add_parser("startup")
+    startup.set_defaults(func=bench_startup)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+from core import Tetromino, Pentomino
+from engine import Action, SPAWN_COORDS
+from collections import OrderedDict
+from multiprocessing import get_context
+from random import Random
+from time import perf_counter
+
+# Pieces can stick out of the board by up to 4 tiles of their bounding box
+# and kicks move them by 2 more, the visited table covers that margin
+MARGIN = 6
+SHIFTS = (((Action.LEFT,), -1), ((Action.RIGHT,), 1))
+TURNS = (((Action.ROTATE_CW,), 1), ((Action.ROTATE_CCW,), -1))
+# A piece this far above the stack can't touch it even after kicks
+AIR_GAP = 7
+PIECE_TYPES = {"Tetromino": Tetromino, "Pentomino": Pentomino}
+
+
+def collision_table(board, shape) -> list:
+    # table[rotation][x + MARGIN] has bit y + MARGIN set if the shape fits
+    # at (x, y), so every probe of the search is a single shift and AND
+    width, height = board.width, board.height
+    columns = [0] * width
+    for y, bits in enumerate(board.rows):
+        x = 0
+        while bits:
+            if bits & 1:
+                columns[x] |= 1 << (y + MARGIN)
+            bits >>= 1
+            x += 1
+    table = []
+    for rotation in range(4):
+        left, right, top, bottom = shape.extents[rotation]
+        tiles = shape.rotations[rotation]
+        in_range = ((1 << (height - bottom + top)) - 1) << (MARGIN - top)
+        row = [0] * (width + 2 * MARGIN)
+        for x in range(-left, width - right):
+            blocked = 0
+            for dx, dy in tiles:
+                blocked |= columns[x + dx] >> dy
+            row[x + MARGIN] = in_range & ~blocked
+        table.append(row)
+    return table
+
+
+def reachable_placements(board, piece) -> dict:
+    # Breadth-first search over (x, y, rotation) from the piece position,
+    # using the same moves and kicks as TetrisBoard. Returns
+    # {(x, y, rotation): actions} for every resting position and an input
+    # sequence that reaches it. Above the stack nothing but the walls can
+    # block the piece, so soft drops there jump straight down to the
+    # lowest such row instead of visiting every row in between.
+    kick_data = piece.shape.kick_data
+    air_row = min(board.col_tops) - AIR_GAP
+    table = collision_table(board, piece.shape)
+    span_x = board.width + 2 * MARGIN
+    span_y = board.height + 2 * MARGIN
+    visited = bytearray(4 * span_y * span_x)
+    x, y = piece.coords
+    states = [(x, y, piece.rotation)]
+    parents = [-1]
+    actions = [()]
+    visited[(piece.rotation * span_y + y + MARGIN) * span_x + x + MARGIN] = 1
+    placements = {}
+    index = 0
+    while index < len(states):
+        x, y, rotation = states[index]
+        if not table[rotation][x + MARGIN] >> (y + 1 + MARGIN) & 1:
+            placements[(x, y, rotation)] = index
+        row = table[rotation]
+        for action, dx in SHIFTS:
+            key = (rotation * span_y + y + MARGIN) * span_x + x + dx + MARGIN
+            if not visited[key] and row[x + dx + MARGIN] >> (y + MARGIN) & 1:
+                visited[key] = 1
+                states.append((x + dx, y, rotation))
+                parents.append(index)
+                actions.append(action)
+        ny = max(y + 1, air_row)
+        key = (rotation * span_y + ny + MARGIN) * span_x + x + MARGIN
+        if not visited[key] and row[x + MARGIN] >> (ny + MARGIN) & 1:
+            visited[key] = 1
+            states.append((x, ny, rotation))
+            parents.append(index)
+            actions.append((Action.SOFT_DROP,) * (ny - y))
+        for action, turn in TURNS:
+            new_rotation = (rotation + turn) % 4
+            row = table[new_rotation]
+            for kick_x, kick_y in kick_data[(rotation, new_rotation)]:
+                nx = x + kick_x
+                ny = y + kick_y
+                if row[nx + MARGIN] >> (ny + MARGIN) & 1:
+                    key = ((new_rotation * span_y + ny + MARGIN) * span_x +
+                           nx + MARGIN)
+                    if not visited[key]:
+                        visited[key] = 1
+                        states.append((nx, ny, new_rotation))
+                        parents.append(index)
+                        actions.append(action)
+                    break
+        index += 1
+    for placement, index in placements.items():
+        path = []
+        while parents[index] != -1:
+            path.append(actions[index])
+            index = parents[index]
+        placements[placement] = sum(reversed(path), ())
+    return placements
+
+
+def replay(board, actions) -> None:
+    # Plays an input sequence on the board's current piece
+    for action in actions:
+        if action == Action.LEFT:
+            board.horiz_move_curr_piece(False)
+        elif action == Action.RIGHT:
+            board.horiz_move_curr_piece(True)
+        elif action == Action.SOFT_DROP:
+            board.drop_curr_piece()
+        elif action == Action.ROTATE_CW:
+            board.rotate_curr_piece(True)
+        elif action == Action.ROTATE_CCW:
+            board.rotate_curr_piece(False)
+
+
+class SearchBoard(object):
+    # The part of BitboardTetrisBoard the move generator reads, cheap
+    # enough to build for every node of a search
+    __slots__ = ("rows", "col_tops", "width", "height")
+
+    def __init__(self, rows: list, width: int):
+        self.rows = rows
+        self.width = width
+        self.height = len(rows)
+        col_tops = [self.height] * width
+        for y, bits in enumerate(rows):
+            while bits:
+                x = (bits & -bits).bit_length() - 1
+                if col_tops[x] > y:
+                    col_tops[x] = y
+                bits &= bits - 1
+        self.col_tops = col_tops
+
+
+class ZobristTable(object):
+    def __init__(self, width: int, height: int, seed: int = 0):
+        rng = Random(seed)
+        # row_keys[y][bits] is the xor of the keys of every filled cell
+        self.row_keys = []
+        for _ in range(height):
+            cell_keys = [rng.getrandbits(64) for _ in range(width)]
+            keys = [0] * (1 << width)
+            for bits in range(1, 1 << width):
+                low = (bits & -bits).bit_length() - 1
+                keys[bits] = keys[bits & (bits - 1)] ^ cell_keys[low]
+            self.row_keys.append(keys)
+
+    def hash_rows(self, rows: list) -> int:
+        key = 0
+        for y, bits in enumerate(rows):
+            if bits:
+                key ^= self.row_keys[y][bits]
+        return key
+
+
+class TranspositionTable(object):
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value) -> None:
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class BeamSearch(object):
+    # Weights of the board evaluation: aggregate height, holes, bumpiness
+    # and cleared lines
+    HEIGHT = -0.51
+    HOLES = -0.36
+    BUMPINESS = -0.18
+    LINES = 0.76
+
+    def __init__(self, piece_type, width: int = 10, height: int = 40,
+                 beam_width: int = 8, table_size: int = 200000):
+        self.piece_type = piece_type
+        self.shapes = [shape for shape, _ in piece_type.SHAPES]
+        self.width = width
+        self.full_row = (1 << width) - 1
+        self.beam_width = beam_width
+        self.zobrist = ZobristTable(width, height)
+        self.table = TranspositionTable(table_size)
+
+    def place(self, rows: list, key: int, shape, rotation: int,
+              x: int, y: int) -> tuple:
+        # Locks the shape into a copy of rows, returns (rows, lines, key)
+        rows = list(rows)
+        row_keys = self.zobrist.row_keys
+        left = shape.extents[rotation][0]
+        for dy, bits in shape.row_masks[rotation][4]:
+            old = rows[y + dy]
+            rows[y + dy] = old | bits << (x + left)
+            key ^= row_keys[y + dy][old] ^ row_keys[y + dy][rows[y + dy]]
+        full_row = self.full_row
+        kept = [bits for bits in rows if bits != full_row]
+        lines = len(rows) - len(kept)
+        if lines:
+            rows = [0] * lines + kept
+            key = self.zobrist.hash_rows(rows)
+        return rows, lines, key
+
+    def evaluate(self, rows: list, key: int) -> float:
+        value = self.table.get(key)
+        if value is not None:
+            return value
+        height = len(rows)
+        col_tops = SearchBoard(rows, self.width).col_tops
+        heights = [height - top for top in col_tops]
+        holes = 0
+        covered = 0
+        for bits in rows[min(col_tops):]:
+            holes += (covered & ~bits).bit_count()
+            covered |= bits
+        bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+        value = (self.HEIGHT * sum(heights) + self.HOLES * holes +
+                 self.BUMPINESS * bumpiness)
+        self.table.put(key, value)
+        return value
+
+    def search(self, rows: list, piece, preview: list,
+               time_budget: float = None) -> tuple:
+        # piece is the falling TetrisPiece, preview the shapes that follow.
+        # Returns the actions placing the current piece (without the final
+        # hard drop), searching deeper into the preview while time allows.
+        deadline = None if time_budget is None else \
+            perf_counter() + time_budget
+        spawn_piece = self.piece_type(piece.coords, piece.shape, None,
+                                      piece.rotation)
+        key = self.zobrist.hash_rows(rows)
+        # (value, lines value, rows, key, first actions)
+        beam = [(0.0, 0.0, rows, key, None)]
+        best = ()
+        for depth, shape in enumerate([piece.shape] + list(preview)):
+            if depth:
+                spawn_piece = self.piece_type(SPAWN_COORDS, shape, None)
+            candidates = []
+            for _, lines_value, rows, key, first in beam:
+                board = SearchBoard(rows, self.width)
+                if not board_fits(board, spawn_piece):
+                    continue
+                placements = reachable_placements(board, spawn_piece)
+                for (x, y, rotation), actions in placements.items():
+                    new_rows, lines, new_key = self.place(
+                        rows, key, shape, rotation, x, y)
+                    new_lines_value = lines_value + self.LINES * lines
+                    value = new_lines_value + self.evaluate(new_rows,
+                                                            new_key)
+                    candidates.append((value, new_lines_value, new_rows,
+                                       new_key,
+                                       actions if first is None else first))
+                if deadline is not None and perf_counter() > deadline:
+                    break
+            if not candidates:
+                break
+            candidates.sort(key=lambda node: node[0], reverse=True)
+            beam = candidates[:self.beam_width]
+            best = beam[0][4]
+            if deadline is not None and perf_counter() > deadline:
+                break
+        return best
+
+
+def board_fits(board, piece) -> bool:
+    left, _, _, _, masks = piece.shape.row_masks[piece.rotation]
+    x, y = piece.coords
+    for dy, bits in masks:
+        if board.rows[y + dy] & (bits << (x + left)):
+            return False
+    return True
+
+
+def search_worker(piece_type_name, beam_width, requests, results) -> None:
+    # Runs in its own process, always answering the latest request only
+    piece_type = PIECE_TYPES[piece_type_name]
+    search = BeamSearch(piece_type, beam_width=beam_width)
+    while True:
+        request = requests.get()
+        while request is not None and not requests.empty():
+            request = requests.get()
+        if request is None:
+            break
+        request_id, rows, shape_index, rotation, coords, preview, budget = \
+            request
+        piece = piece_type(coords, *piece_type.SHAPES[shape_index])
+        piece.set_rotation(rotation)
+        preview = [search.shapes[index] for index in preview]
+        results.put((request_id, search.search(rows, piece, preview, budget)))
+
+
+class AIPlayer(object):
+    def __init__(self, piece_type, time_budget: float = 0.1,
+                 beam_width: int = 8, preview: int = 2):
+        self.piece_type = piece_type
+        self.shapes = [shape for shape, _ in piece_type.SHAPES]
+        self.time_budget = time_budget
+        self.preview = preview
+        context = get_context("spawn")
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=search_worker,
+            args=(piece_type.__name__, beam_width,
+                  self.requests, self.results),
+            daemon=True)
+        self.process.start()
+        self.request_id = 0
+        self.pending = False
+
+    def request(self, engine) -> None:
+        self.request_id += 1
+        self.pending = True
+        piece = engine.board.get_curr_piece()
+        preview = [self.shapes.index(shape)
+                   for shape in preview_shapes(engine, self.preview)]
+        self.requests.put((self.request_id, list(engine.board.rows),
+                           self.shapes.index(piece.shape), piece.rotation,
+                           piece.coords, preview, self.time_budget))
+
+    def poll(self):
+        # Actions for the latest request once they are ready, else None
+        while self.pending and not self.results.empty():
+            request_id, actions = self.results.get()
+            if request_id == self.request_id:
+                self.pending = False
+                return actions + (Action.HARD_DROP,)
+        return None
+
+    def close(self) -> None:
+        self.requests.put(None)
+        self.process.join(1)
+
+
+def preview_shapes(engine, count: int) -> list:
+    # The next piece and the queued ones after it, in drawing order
+    return [engine.next_piece.shape] + \
+        [shape for shape, _ in engine.randomizer.upcoming(count - 1)]
+
+
+policy_searches = {}
+
+
+def beam_policy(engine, rng):
+    # Synchronous policy for simulate.py, one search per piece type
+    if engine.piece_type not in policy_searches:
+        policy_searches[engine.piece_type] = BeamSearch(engine.piece_type)
+    search = policy_searches[engine.piece_type]
+    actions = search.search(list(engine.board.rows),
+                            engine.board.get_curr_piece(),
+                            preview_shapes(engine, 2))
+    return actions + (Action.HARD_DROP,)
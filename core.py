@@ -1,47 +1,48 @@
-import pygame
 from operator import add
-from random import shuffle
+from random import Random
 from copy import copy
 from collections import defaultdict
 
 
 class ColorMap(object):
-    CLEAR = pygame.Color("black")
-    RED = pygame.Color("red")
-    BLUE = pygame.Color("blue")
-    GREEN = pygame.Color("green")
-    YELLOW = pygame.Color("yellow")
-    MAGENTA = pygame.Color("magenta")
-    CYAN = pygame.Color("cyan")
-    ORANGE = pygame.Color("orange")
-    WHITE = pygame.Color("white")
-    LIGHTGREEN = pygame.Color("lightgreen")
-    GHOST = pygame.Color("darkgrey")
-    PINK = pygame.Color("pink")
-    LIGHTCYAN = pygame.Color("lightcyan")
-    PURPLE = pygame.Color("purple")
-    BG = pygame.Color("#25221E")
-
-    # CLEAR = "clear"
-    # RED = "red"
-    # BLUE = "blue"
-    # GREEN = "green"
-    # YELLOW = "yellow"
-    # MAGENTA = "magenta"
-    # CYAN = "cyan"
-    # ORANGE = "orange"
+    # Plain RGB tuples keep the core free of pygame, which accepts them as is
+    CLEAR = (0, 0, 0)
+    RED = (255, 0, 0)
+    BLUE = (0, 0, 255)
+    GREEN = (0, 255, 0)
+    YELLOW = (255, 255, 0)
+    MAGENTA = (255, 0, 255)
+    CYAN = (0, 255, 255)
+    ORANGE = (255, 165, 0)
+    WHITE = (255, 255, 255)
+    LIGHTGREEN = (144, 238, 144)
+    GHOST = (169, 169, 169)
+    PINK = (255, 192, 203)
+    LIGHTCYAN = (224, 255, 255)
+    PURPLE = (160, 32, 240)
+    BG = (37, 34, 30)
 
 
 class Shape(object):
+    __slots__ = ("tiles", "bbox_size", "kick_data",
+                 "rotations", "extents", "row_masks", "skirts")
+
     def __init__(self, tiles: tuple, bbox_size: int, kick_data: dict):
         self.tiles = tiles
         self.bbox_size = bbox_size
         self.kick_data = kick_data
-
-    def get_tiles(self) -> tuple:
-        return self.tiles
-
-    def calculate_rotation(self, rotation) -> tuple:
+        # All four rotations are built once, pieces only look them up
+        self.rotations = tuple(self._rotate(rotation)
+                               for rotation in range(4))
+        self.extents = tuple(self._calculate_extents(tiles)
+                             for tiles in self.rotations)
+        self.row_masks = tuple(self._calculate_row_masks(tiles, extents)
+                               for tiles, extents in zip(self.rotations,
+                                                         self.extents))
+        self.skirts = tuple(self._calculate_skirt(tiles)
+                            for tiles in self.rotations)
+
+    def _rotate(self, rotation) -> tuple:
         box = [[False] * self.bbox_size for _ in range(self.bbox_size)]
         for tile in self.tiles:
             box[tile[0]][tile[1]] = True
@@ -54,6 +55,41 @@ class Shape(object):
                     tiles.append((x, y))
         return tuple(tiles)
 
+    @staticmethod
+    def _calculate_extents(tiles: tuple) -> tuple:
+        # (left, right, top, bottom)
+        return (min(x for x, _ in tiles), max(x for x, _ in tiles),
+                min(y for _, y in tiles), max(y for _, y in tiles))
+
+    @staticmethod
+    def _calculate_row_masks(tiles: tuple, extents: tuple) -> tuple:
+        # (left, right, top, bottom, ((dy, bits), ...)), bits relative to left
+        left = extents[0]
+        masks = defaultdict(int)
+        for x, y in tiles:
+            masks[y] |= 1 << (x - left)
+        return extents + (tuple(sorted(masks.items())),)
+
+    @staticmethod
+    def _calculate_skirt(tiles: tuple) -> tuple:
+        # Tiles with nothing of the piece right below them
+        return tuple((x, y) for x, y in tiles if (x, y + 1) not in tiles)
+
+    def get_tiles(self) -> tuple:
+        return self.tiles
+
+    def calculate_rotation(self, rotation) -> tuple:
+        return self.rotations[rotation]
+
+    def get_extents(self, rotation) -> tuple:
+        return self.extents[rotation]
+
+    def get_row_masks(self, rotation) -> tuple:
+        return self.row_masks[rotation]
+
+    def get_skirt(self, rotation) -> tuple:
+        return self.skirts[rotation]
+
     def get_bbox_size(self) -> int:
         return self.bbox_size
 
@@ -62,10 +98,12 @@ class Shape(object):
 
 
 class TetrisPiece(object):
+    __slots__ = ("coords", "shape", "color", "rotation")
+
     def __init__(self,
                  coords: tuple,
                  shape: Shape,
-                 color: pygame.Color,
+                 color: tuple,
                  rotation=0):
         self.coords = coords
         self.shape = shape
@@ -73,8 +111,8 @@ class TetrisPiece(object):
         self.rotation = rotation
 
     def draw(self, field) -> None:
-        for x, y in self.shape.calculate_rotation(self.rotation):
-            field.set_tile((self.shape[0] + x, self.shape[1] + y), self.color)
+        for x, y in self.shape.rotations[self.rotation]:
+            field.set_tile((self.coords[0] + x, self.coords[1] + y), self.color)
 
     def rotate(self, direction: bool) -> None:
         if direction:
@@ -90,13 +128,13 @@ class TetrisPiece(object):
 
     def get_tiles_coords(self) -> tuple:
         x, y = self.coords
-        return tuple(map(lambda tile: (x + tile[0], y + tile[1]),
-                         self.shape.calculate_rotation(self.rotation)))
+        return tuple([(x + dx, y + dy)
+                      for dx, dy in self.shape.rotations[self.rotation]])
 
     def get_shape(self) -> Shape:
         return self.shape
 
-    def get_color(self) -> pygame.Color:
+    def get_color(self) -> tuple:
         return self.color
 
     def __copy__(self):
@@ -119,6 +157,7 @@ class TetrisPiece(object):
 
 
 class Tetromino(TetrisPiece):
+    __slots__ = ()
     wall_kicks = {
         (0, 1): ((0, 0), (-1, 0), (-1, 1), (0, -2), (-1, 2)),
         (1, 0): ((0, 0), (1, 0), (1, -1), (0, 2), (1, 2)),
@@ -157,6 +196,7 @@ class Tetromino(TetrisPiece):
 
 
 class Pentomino(TetrisPiece):
+    __slots__ = ()
     wall_kicks = defaultdict(lambda: ((0, 0),))
     I_SH = (Shape(((0, 2), (1, 2), (2, 2), (3, 2), (4, 2)),
                   5, wall_kicks), ColorMap.RED)
@@ -209,11 +249,11 @@ class BaseTileField(object):
         self.tiles = [[ColorMap.CLEAR] *
                       self.height for _ in range(self.width)]
 
-    def set_tile(self, coords: tuple, color: pygame.Color) -> None:
+    def set_tile(self, coords: tuple, color: tuple) -> None:
         if 0 <= coords[0] < self.width and 0 <= coords[1] < self.height:
             self.tiles[coords[0]][coords[1]] = color
 
-    def get_tile(self, coords) -> pygame.Color:
+    def get_tile(self, coords) -> tuple:
         return self.tiles[coords[0]][coords[1]]
 
     def get_tiles(self) -> list:
@@ -224,15 +264,36 @@ class BaseTileField(object):
 
 
 class TetrisBoard(BaseTileField):
-    def __init__(self, clear_val=ColorMap.CLEAR):
-        super().__init__(10, 40)
+    def __init__(self, clear_val=ColorMap.CLEAR, width: int = 10,
+                 height: int = 40):
+        # Objects told about every change of the locked tiles
+        self.listeners = []
+        super().__init__(width, height)
         self.clear_val = clear_val
         self.reset()
 
+    def add_listener(self, listener) -> None:
+        # listener implements on_tiles_put(coords, color),
+        # on_rows_cleared(rows) and on_board_reset()
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener) -> None:
+        self.listeners.remove(listener)
+
+    def notify(self, event: str, *args) -> None:
+        for listener in self.listeners:
+            getattr(listener, event)(*args)
+
     def reset(self) -> None:
         self.curr_piece = None
         self.curr_piece_moved = False
         self.clear()
+        self.notify("on_board_reset")
+
+    def set_tile(self, coords: tuple, color: tuple) -> None:
+        super().set_tile(coords, color)
+        if 0 <= coords[0] < self.width and 0 <= coords[1] < self.height:
+            self.notify("on_tiles_put", (coords,), color)
 
     def clear_tile(self, coords: tuple) -> None:
         self.tiles[coords[0]][coords[1]] = ColorMap.CLEAR
@@ -243,15 +304,16 @@ class TetrisBoard(BaseTileField):
     def clear_row(self, row: int) -> None:
         for x in range(self.width):
             self.clear_tile((x, row))
+        self.notify("on_rows_cleared", (row,))
 
     def rotate_curr_piece(self, rotation) -> None:
-        temp_piece = copy(self.curr_piece)
-        curr_rot = temp_piece.get_rotation()
-        temp_piece.rotate(rotation)
-        new_rot = temp_piece.get_rotation()
-        for kick in temp_piece.get_kick_data(curr_rot, new_rot):
-            if self.piece_can_move(temp_piece, kick):
-                self.curr_piece.rotate(rotation)
+        piece = self.curr_piece
+        curr_rot = piece.rotation
+        new_rot = (curr_rot + (1 if rotation else -1)) % 4
+        x, y = piece.coords
+        for kick in piece.get_kick_data(curr_rot, new_rot):
+            if self.can_place(piece.shape, new_rot, x + kick[0], y + kick[1]):
+                piece.set_rotation(new_rot)
                 self.move_curr_piece(kick)
                 break
 
@@ -272,8 +334,10 @@ class TetrisBoard(BaseTileField):
         self.curr_piece = piece
 
     def put_curr_piece(self) -> None:
-        for x, y in self.curr_piece.get_tiles_coords():
+        coords = self.curr_piece.get_tiles_coords()
+        for x, y in coords:
             self.tiles[x][y] = self.curr_piece.get_color()
+        self.notify("on_tiles_put", coords, self.curr_piece.get_color())
         self.curr_piece = None
 
     def drop_curr_piece(self) -> None:
@@ -281,15 +345,35 @@ class TetrisBoard(BaseTileField):
             self.move_curr_piece((0, 1))
 
     def hard_drop_curr_piece(self) -> None:
-        while self.piece_can_move(self.curr_piece, (0, 1)):
-            self.curr_piece.move((0, 1))
+        piece = self.curr_piece
+        x, y = piece.coords
+        piece.set_coords((x, y + self.get_drop_distance(piece)))
         self.curr_piece_moved = False
 
+    def get_drop_distance(self, piece) -> int:
+        shape, rotation = piece.shape, piece.rotation
+        x, y = piece.coords
+        distance = 0
+        while self.can_place(shape, rotation, x, y + distance + 1):
+            distance += 1
+        return distance
+
+    def can_place(self, shape: Shape, rotation: int, x: int, y: int) -> bool:
+        left, right, top, bottom = shape.extents[rotation]
+        if (x + left < 0 or x + right >= self.width or
+                y + top < 0 or y + bottom >= self.height):
+            return False
+        tiles = self.tiles
+        clear_val = self.clear_val
+        for dx, dy in shape.rotations[rotation]:
+            if tiles[x + dx][y + dy] != clear_val:
+                return False
+        return True
+
     def piece_can_move(self, piece, coords_delta: tuple):
-        temp_piece = copy(piece)
-        temp_piece.move(coords_delta)
-        return not (self.piece_collides_borders(temp_piece) or
-                    self.piece_collides_tiles(temp_piece))
+        x, y = piece.coords
+        return self.can_place(piece.shape, piece.rotation,
+                              x + coords_delta[0], y + coords_delta[1])
 
     def is_tile_empty(self, coords: tuple) -> bool:
         return self.tiles[coords[0]][coords[1]] == self.clear_val
@@ -308,14 +392,32 @@ class TetrisBoard(BaseTileField):
     def is_row_full(self, row: int) -> bool:
         return not any(map(lambda x: self.is_tile_empty((x, row)), range(self.width)))
 
-    def clear_filled_rows(self, scorecounter: callable = None):
-        cleared_rows = 0
-        for row in range(self.height):
-            if self.is_row_full(row):
-                self.clear_row(row)
-                cleared_rows += 1
+    def get_full_rows(self) -> tuple:
+        clear_val = self.clear_val
+        filled = [True] * self.height
+        for column in self.tiles:
+            for y, tile in enumerate(column):
+                if tile == clear_val:
+                    filled[y] = False
+        return tuple(y for y, full in enumerate(filled) if full)
+
+    def clear_rows(self, rows: tuple) -> None:
+        # Drops every surviving row in one sweep per column
+        if not rows:
+            return
+        cleared = set(rows)
+        kept = [y for y in range(self.height) if y not in cleared]
+        padding = [ColorMap.CLEAR] * len(cleared)
+        for column in self.tiles:
+            column[:] = padding + [column[y] for y in kept]
+        self.notify("on_rows_cleared", rows)
+
+    def clear_filled_rows(self, scorecounter: callable = None) -> tuple:
+        cleared_rows = self.get_full_rows()
+        self.clear_rows(cleared_rows)
         if scorecounter is not None:
-            scorecounter(cleared_rows)
+            scorecounter(len(cleared_rows))
+        return cleared_rows
 
     def get_curr_piece(self):
         return self.curr_piece
@@ -323,35 +425,200 @@ class TetrisBoard(BaseTileField):
     def get_ghost_piece(self):
         ghost = copy(self.curr_piece)
         ghost.ghostify()
-        while self.piece_can_move(ghost, (0, 1)):
-            ghost.move((0, 1))
+        x, y = ghost.coords
+        ghost.set_coords((x, y + self.get_drop_distance(ghost)))
         return ghost
 
     def check_lock_delay(self):
         curr_piece_moved = self.curr_piece_moved
         self.curr_piece_moved = False
-        return not (self.piece_can_move(self.curr_piece, (0, 1)) or curr_piece_moved)
+        piece = self.curr_piece
+        x, y = piece.coords
+        return not (self.can_place(piece.shape, piece.rotation, x, y + 1) or
+                    curr_piece_moved)
 
     def get_curr_piece_moved(self):
         return self.curr_piece_moved
 
 
+class BitboardTetrisBoard(TetrisBoard):
+    def __init__(self, clear_val=ColorMap.CLEAR, width: int = 10,
+                 height: int = 40):
+        super().__init__(clear_val, width, height)
+        self.full_row = (1 << self.width) - 1
+
+    def clear(self) -> None:
+        super().clear()
+        self.rows = [0] * self.height
+        # Topmost filled row of every column, height if the column is empty
+        self.col_tops = [self.height] * self.width
+
+    def set_tile(self, coords: tuple, color: tuple) -> None:
+        super().set_tile(coords, color)
+        x, y = coords
+        if 0 <= x < self.width and 0 <= y < self.height:
+            if color == self.clear_val:
+                self.rows[y] &= ~(1 << x)
+                if self.col_tops[x] == y:
+                    self.col_tops[x] = self.find_filled_below(x, y)
+            else:
+                self.rows[y] |= 1 << x
+                self.col_tops[x] = min(self.col_tops[x], y)
+
+    def find_filled_below(self, col: int, row: int) -> int:
+        # First filled row strictly below row, height if there is none
+        rows = self.rows
+        bit = 1 << col
+        for y in range(row + 1, self.height):
+            if rows[y] & bit:
+                return y
+        return self.height
+
+    def clear_row(self, row: int) -> None:
+        super().clear_row(row)
+        del self.rows[row]
+        self.rows.insert(0, 0)
+        self.update_col_tops()
+
+    def update_col_tops(self) -> None:
+        # Rows only ever move down, so every top is searched from its old value
+        rows = self.rows
+        for x, top in enumerate(self.col_tops):
+            if top < self.height and not rows[top] >> x & 1:
+                self.col_tops[x] = self.find_filled_below(x, top)
+
+    def get_full_rows(self) -> tuple:
+        full_row = self.full_row
+        return tuple(y for y, bits in enumerate(self.rows) if bits == full_row)
+
+    def clear_rows(self, rows: tuple) -> None:
+        if not rows:
+            return
+        super().clear_rows(rows)
+        cleared = set(rows)
+        self.rows[:] = [0] * len(cleared) + [bits for y, bits
+                                             in enumerate(self.rows)
+                                             if y not in cleared]
+        self.update_col_tops()
+
+    def put_curr_piece(self) -> None:
+        color = self.curr_piece.get_color()
+        col_tops = self.col_tops
+        coords = self.curr_piece.get_tiles_coords()
+        for x, y in coords:
+            self.tiles[x][y] = color
+            self.rows[y] |= 1 << x
+            if y < col_tops[x]:
+                col_tops[x] = y
+        self.notify("on_tiles_put", coords, color)
+        self.curr_piece = None
+
+    def get_drop_distance(self, piece) -> int:
+        x, y = piece.coords
+        col_tops = self.col_tops
+        distance = self.height
+        for dx, dy in piece.shape.skirts[piece.rotation]:
+            row = y + dy
+            top = col_tops[x + dx]
+            if top <= row:
+                # Piece is tucked under an overhang, look below it instead
+                top = self.find_filled_below(x + dx, row)
+            if top - row - 1 < distance:
+                distance = top - row - 1
+        return distance
+
+    def can_place(self, shape: Shape, rotation: int, x: int, y: int) -> bool:
+        left, right, top, bottom, masks = shape.row_masks[rotation]
+        if (x + left < 0 or x + right >= self.width or
+                y + top < 0 or y + bottom >= self.height):
+            return False
+        rows = self.rows
+        shift = x + left
+        for dy, bits in masks:
+            if rows[y + dy] & (bits << shift):
+                return False
+        return True
+
+    def piece_collides_tiles(self, piece: TetrisPiece) -> bool:
+        left, _, _, _, masks = piece.shape.row_masks[piece.rotation]
+        x, y = piece.coords
+        rows = self.rows
+        shift = x + left
+        for dy, bits in masks:
+            if rows[y + dy] & (bits << shift):
+                return True
+        return False
+
+    def is_tile_empty(self, coords: tuple) -> bool:
+        return not self.rows[coords[1]] >> coords[0] & 1
+
+    def is_row_full(self, row: int) -> bool:
+        return self.rows[row] == self.full_row
+
+
 class RandomBag(object):
-    def __init__(self, variants):
-        self.variants = variants
+    # Bag randomizer with its own PRNG, so a seed replays the same game.
+    # Upcoming variants wait in a ring buffer at least depth long, which
+    # makes peek() O(1) and lets the whole state be saved and restored
+    def __init__(self, variants, seed=None, depth: int = 6):
+        self.variants = tuple(variants)
+        self.depth = depth
+        self.random = Random(seed)
         self.shuffle()
 
     def shuffle(self):
-        self.seq = list(self.variants)
-        shuffle(self.seq)
+        # Drop the queued variants and start from a fresh bag
+        self.set_queue(())
+        self.fill()
+
+    def set_queue(self, indices):
+        # Room for the preview plus one whole bag appended on refill
+        self.queue = list(indices) + [0] * (self.depth + len(self.variants))
+        self.head = 0
+        self.count = len(indices)
+
+    def fill(self):
+        size = len(self.queue)
+        while self.count < self.depth or not self.count:
+            bag = list(range(len(self.variants)))
+            self.random.shuffle(bag)
+            # Bags used to be popped from the end, keep the seeded order
+            for index in reversed(bag):
+                self.queue[(self.head + self.count) % size] = index
+                self.count += 1
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if not self.seq:
-            self.shuffle()
-        return self.seq.pop()
-
-    def get_sequence(self):
-        return self.seq
+        index = self.queue[self.head]
+        self.head = (self.head + 1) % len(self.queue)
+        self.count -= 1
+        self.fill()
+        return self.variants[index]
+
+    def peek(self, index: int = 0):
+        # Variant returned by the (index + 1)-th next() from now
+        if not 0 <= index < self.count:
+            raise IndexError("peek beyond the preview queue")
+        return self.variants[self.queue[(self.head + index) % len(self.queue)]]
+
+    def upcoming(self, count: int = None):
+        # Generator over the queued variants, nothing is copied
+        count = self.count if count is None else min(count, self.count)
+        for index in range(count):
+            yield self.peek(index)
+
+    def get_state(self) -> tuple:
+        # Only ints and tuples, fit for pickle, json needs set_state to
+        # turn lists back into tuples
+        size = len(self.queue)
+        queued = tuple(self.queue[(self.head + i) % size]
+                       for i in range(self.count))
+        return self.random.getstate(), queued
+
+    def set_state(self, state) -> None:
+        (version, internal, gauss), queued = state
+        self.random.setstate((version, tuple(internal), gauss))
+        self.set_queue(queued)
+        self.fill()
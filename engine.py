@@ -0,0 +1,197 @@
+from core import BitboardTetrisBoard, ColorMap, RandomBag
+from math import sqrt
+from time import perf_counter
+
+TICK_RATE = 60
+SPAWN_COORDS = (4, 21)
+
+
+class Action(object):
+    LEFT = "left"
+    RIGHT = "right"
+    ROTATE_CW = "rotate_cw"
+    ROTATE_CCW = "rotate_ccw"
+    SOFT_DROP = "soft_drop"
+    HARD_DROP = "hard_drop"
+    HOLD = "hold"
+
+
+class GameEvent(object):
+    HOLD = "hold"
+    HARD_DROP = "hard_drop"
+    LOCK = "lock"
+    LINES_CLEARED = "lines_cleared"
+    LEVEL_UP = "level_up"
+    GAME_OVER = "game_over"
+
+
+class TetrisEngine(object):
+    def __init__(self, piece_type, tick_rate: int = TICK_RATE, seed=None):
+        # Save init params
+        self.piece_type = piece_type
+        self.tick_rate = tick_rate
+        # Initialise board and randomizer
+        self.board = BitboardTetrisBoard(ColorMap.CLEAR)
+        self.randomizer = RandomBag(piece_type.SHAPES, seed)
+        self.reset()
+
+    def reset(self) -> None:
+        self.board.reset()
+        self.game_over = False
+        self.score = 0
+        self.level = 1
+        self.combo = 0
+        # Weighted lines towards the next level
+        self.total_lines = 0
+        self.lines = 0
+        self.pieces = 0
+        self.ticks = 0
+        self.randomizer.shuffle()
+        self.hold_piece = None
+        self.next_piece = self.choose_piece()
+        self.hold_used = False
+        self.board.new_piece(self.choose_piece())
+        self.lock_delay_ticks = 0
+        # Gravity runs in ms * tick_rate units to stay exact for any rate
+        self.gravity_acc = 0
+        self.events = []
+
+    def choose_piece(self):
+        return self.piece_type((0, 0), *next(self.randomizer))
+
+    def level_delay(self) -> int:
+        return round(700 / sqrt(self.level))
+
+    def lock_delay(self) -> int:
+        return self.tick_rate // 2
+
+    def hold(self) -> None:
+        if self.hold_used:
+            return
+        self.hold_used = True
+        if self.hold_piece is None:
+            self.hold_piece = self.board.get_curr_piece()
+            self.board.new_piece(self.next_piece)
+            self.next_piece = self.choose_piece()
+        else:
+            new_hold_piece = self.board.get_curr_piece()
+            self.board.new_piece(self.hold_piece)
+            self.hold_piece = new_hold_piece
+        self.hold_piece.set_coords((0, 0))
+        self.events.append(GameEvent.HOLD)
+
+    def apply_action(self, action) -> None:
+        if action == Action.RIGHT:
+            self.board.horiz_move_curr_piece(True)
+        elif action == Action.LEFT:
+            self.board.horiz_move_curr_piece(False)
+        elif action == Action.ROTATE_CW:
+            self.board.rotate_curr_piece(True)
+        elif action == Action.ROTATE_CCW:
+            self.board.rotate_curr_piece(False)
+        elif action == Action.SOFT_DROP:
+            self.board.drop_curr_piece()
+        elif action == Action.HARD_DROP:
+            self.board.hard_drop_curr_piece()
+            self.lock_delay_ticks = self.tick_rate
+            self.events.append(GameEvent.HARD_DROP)
+        elif action == Action.HOLD:
+            self.hold()
+
+    def score_counter(self, cleared_rows: int) -> None:
+        if cleared_rows == 0:
+            self.combo = 0
+        elif cleared_rows == 1:
+            self.score += 100 * self.level
+            self.total_lines += 1
+        elif cleared_rows == 2:
+            self.score += 300 * self.level
+            self.total_lines += 3
+        elif cleared_rows == 3:
+            self.score += 500 * self.level
+            self.total_lines += 5
+        elif cleared_rows == 4:
+            self.score += 800 * self.level
+            self.total_lines += 8
+        if self.combo > 1:
+            self.score += self.combo * self.level + 50 * self.level
+        if self.total_lines >= self.level * 5:
+            self.total_lines = 0
+            self.level += 1
+            self.gravity_acc = 0
+            self.events.append(GameEvent.LEVEL_UP)
+
+    def lock_curr_piece(self) -> None:
+        self.hold_used = False
+        self.lock_delay_ticks = 0
+        self.board.put_curr_piece()
+        self.pieces += 1
+        cleared_rows = self.board.clear_filled_rows(self.score_counter)
+        self.events.append(GameEvent.LOCK)
+        if cleared_rows:
+            self.lines += len(cleared_rows)
+            self.events.append(GameEvent.LINES_CLEARED)
+        self.next_piece.set_coords(SPAWN_COORDS)
+        if self.board.piece_collides_tiles(self.next_piece):
+            self.game_over = True
+            self.events.append(GameEvent.GAME_OVER)
+        self.board.new_piece(self.next_piece)
+        self.next_piece = self.choose_piece()
+
+    def step(self, actions=()) -> list:
+        self.events = []
+        if self.game_over:
+            return self.events
+        self.ticks += 1
+        for action in actions:
+            self.apply_action(action)
+        self.gravity_acc += 1000
+        if self.gravity_acc >= self.level_delay() * self.tick_rate:
+            self.gravity_acc -= self.level_delay() * self.tick_rate
+            self.board.drop_curr_piece()
+        if self.board.check_lock_delay():
+            self.lock_delay_ticks += 1
+        else:
+            self.lock_delay_ticks = 0
+        if self.lock_delay_ticks >= self.lock_delay():
+            self.lock_curr_piece()
+        return self.events
+
+    def get_score(self) -> int:
+        return self.score
+
+    def get_level(self) -> int:
+        return self.level
+
+    def get_ghost_piece(self):
+        return self.board.get_ghost_piece()
+
+
+class FixedTimestep(object):
+    # Turns elapsed real time into a whole number of fixed length logic
+    # ticks, carrying the remainder over, so game timing doesn't depend on
+    # how fast frames are rendered
+    def __init__(self, tick_rate: int = TICK_RATE, max_ticks: int = 10,
+                 clock: callable = perf_counter):
+        self.tick_rate = tick_rate
+        self.tick_length = 1 / tick_rate
+        # After a long stall the backlog is dropped instead of replayed
+        self.max_ticks = max_ticks
+        self.clock = clock
+        self.reset()
+
+    def reset(self) -> None:
+        self.last_time = self.clock()
+        self.accumulator = 0.0
+
+    def advance(self) -> int:
+        now = self.clock()
+        self.accumulator += now - self.last_time
+        self.last_time = now
+        ticks = int(self.accumulator / self.tick_length)
+        if ticks > self.max_ticks:
+            ticks = self.max_ticks
+            self.accumulator = 0.0
+        else:
+            self.accumulator -= ticks * self.tick_length
+        return ticks
@@ -0,0 +1,109 @@
+from collections import deque
+from time import perf_counter
+import sys
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning",
+               ERROR: "error", OFF: "off"}
+
+
+class LogCategory(object):
+    # One subsystem. Call sites test the *_on flags before building any
+    # message, so a disabled level costs a single attribute check:
+    #     if log.debug_on:
+    #         log.debug("lock delay %d", ticks)
+    def __init__(self, logger, name: str, level: int = WARNING):
+        self.logger = logger
+        self.name = name
+        self.set_level(level)
+
+    def set_level(self, level: int) -> None:
+        self.level = level
+        self.debug_on = level <= DEBUG
+        self.info_on = level <= INFO
+        self.warning_on = level <= WARNING
+        self.error_on = level <= ERROR
+
+    def log(self, level: int, message: str, *args) -> None:
+        if level >= self.level:
+            self.logger.emit(self.name, level, message, args)
+
+    def debug(self, message: str, *args) -> None:
+        self.log(DEBUG, message, *args)
+
+    def info(self, message: str, *args) -> None:
+        self.log(INFO, message, *args)
+
+    def warning(self, message: str, *args) -> None:
+        self.log(WARNING, message, *args)
+
+    def error(self, message: str, *args) -> None:
+        self.log(ERROR, message, *args)
+
+
+class Logger(object):
+    # Records go to a ring buffer and are only formatted when dumped or
+    # echoed, echo is off unless a stream is given
+    def __init__(self, capacity: int = 2048, stream=None,
+                 stream_level: int = WARNING):
+        self.records = deque(maxlen=capacity)
+        self.categories = {}
+        # Level of categories created later
+        self.level = WARNING
+        self.stream = stream
+        self.stream_level = stream_level
+        self.start = perf_counter()
+
+    def category(self, name: str) -> LogCategory:
+        if name not in self.categories:
+            self.categories[name] = LogCategory(self, name, self.level)
+        return self.categories[name]
+
+    def set_level(self, level: int, name: str = None) -> None:
+        # Without a name every category gets the level
+        if name is not None:
+            self.category(name).set_level(level)
+            return
+        self.level = level
+        for category in self.categories.values():
+            category.set_level(level)
+
+    def configure(self, spec: str) -> None:
+        # "debug" or "game=debug,audio=info", unknown levels are ignored
+        levels = {name: level for level, name in LEVEL_NAMES.items()}
+        for item in filter(None, spec.split(",")):
+            name, _, level = item.strip().rpartition("=")
+            if level.lower() in levels:
+                self.set_level(levels[level.lower()], name or None)
+
+    def emit(self, name: str, level: int, message: str, args: tuple) -> None:
+        record = (perf_counter() - self.start, name, level, message, args)
+        self.records.append(record)
+        if self.stream is not None and level >= self.stream_level:
+            self.stream.write(self.format(record) + "\n")
+
+    def format(self, record) -> str:
+        time, name, level, message, args = record
+        if args:
+            message = message % args
+        return f"{time:10.4f} {LEVEL_NAMES[level]:7} {name:8} {message}"
+
+    def dump(self, stream=None) -> None:
+        stream = sys.stderr if stream is None else stream
+        for record in self.records:
+            stream.write(self.format(record) + "\n")
+        stream.flush()
+
+    def clear(self) -> None:
+        self.records.clear()
+
+
+default_logger = Logger()
+
+
+def get_log(name: str) -> LogCategory:
+    return default_logger.category(name)
@@ -1,19 +1,46 @@
-from core import TetrisBoard, Tetromino, Pentomino, ColorMap, RandomBag
+from core import Tetromino, Pentomino, ColorMap
+from engine import TetrisEngine, Action, GameEvent, FixedTimestep, TICK_RATE
+from bot import AIPlayer
 from render import *
+from assets import default_assets
+from audio import default_music, default_audio
+from gamelog import default_logger, get_log
+from profiler import FrameProfiler, default_profiler
 import pygame
-from sys import exit
+from sys import exit, stderr
 from random import choice
-from math import sqrt
 import os
 
 TETSIS_HS_FILENAME = "tetris_hs"
 PENTIX_HS_FILENAME = "pentix_hs"
-
-
-def load_sound(name):
-    fullname = os.path.join('data/sounds', name)
-    sound = pygame.mixer.Sound(fullname)
-    return sound
+# Loaded in the background while the menu is showing
+GAME_IMAGES = ("game_background.jpg", "pause.jpg", "gameover.jpg")
+# Sound effect -> mixer channel category
+GAME_SOUNDS = {"hold.wav": "piece", "rotate.wav": "piece",
+               "hard_drop.wav": "drop", "pause.wav": "ui",
+               "gameover.wav": "ui"}
+# Streamed, any of data/sounds/main_theme.{ogg,mp3,wav}
+MAIN_THEME = "main_theme"
+# Longest time in ms an idle screen sleeps before checking its state again
+IDLE_TIMEOUT = 500
+# Events after which an idle screen does not need a redraw
+IDLE_EVENTS = (pygame.NOEVENT, pygame.MOUSEMOTION)
+# Writes the in-memory log to stderr
+DUMP_LOG_KEY = pygame.K_F12
+# Shows the frame profiler, writes what it recorded to PROFILE_FILENAME
+# .csv and .json (Chrome trace)
+PROFILER_HUD_KEY = pygame.K_F3
+PROFILE_EXPORT_KEY = pygame.K_F4
+PROFILE_FILENAME = "profile"
+
+log = get_log("game")
+screen_log = get_log("screens")
+
+
+def wait_events(timeout: int = IDLE_TIMEOUT) -> list:
+    # Sleeps until there is input or the timeout ends, then drains the
+    # queue, so idle screens use no CPU between events
+    return [pygame.event.wait(timeout)] + pygame.event.get()
 
 
 def load_highscores(highscores_filename):
@@ -30,106 +57,291 @@ def load_highscores(highscores_filename):
 
 
 class GameWindow(object):
-    def __init__(self, size: tuple):
+    def __init__(self, size: tuple, prefetch: bool = True,
+                 audio_buffer: int = 256, log_levels: str = "",
+                 profile: bool = False):
+        # log_levels like "info" or "game=debug,audio=info", warnings and
+        # errors are also echoed to stderr
+        default_logger.configure(log_levels)
+        default_logger.stream = stderr
+        default_audio.buffer = audio_buffer
+        default_audio.pre_init()
         pygame.init()
         pygame.font.init()
         pygame.mixer.init()
+        for name, category in GAME_SOUNDS.items():
+            default_audio.add_effect(name, category)
+        default_audio.init()
         self.screen = pygame.display.set_mode(size)
-        main_menu = Menu(self.screen)
-        main_menu.run()
-
+        # Profiling also runs while the HUD is shown
+        default_profiler.set_enabled(profile)
+        self.screens = ScreenStack()
+        self.screens.push(Menu(self.screen, prefetch))
+        self.screens.run()
+
+
+class ScreenStack(object):
+    # The only main loop and clock: the top screen gets the events, is
+    # updated and rendered, screens below it wait untouched
+    def __init__(self, profiler: FrameProfiler = default_profiler):
+        self.screens = []
+        self.clock = pygame.time.Clock()
+        self.profiler = profiler
+        self.hud = PygameProfilerHud((5, 80), profiler)
+        self.profile = profiler.enabled
+
+    def top(self):
+        return self.screens[-1] if self.screens else None
+
+    def push(self, screen) -> None:
+        if screen_log.info_on:
+            screen_log.info("push %s", type(screen).__name__)
+        self.screens.append(screen)
+        screen.enter(self)
+
+    def pop(self):
+        screen = self.screens.pop()
+        if screen_log.info_on:
+            screen_log.info("pop %s", type(screen).__name__)
+        screen.leave()
+        if self.screens:
+            self.screens[-1].resume()
+        return screen
+
+    def replace(self, screen):
+        old_screen = self.screens.pop()
+        old_screen.leave()
+        self.push(screen)
+        return old_screen
+
+    def toggle_hud(self) -> None:
+        self.hud.toggle()
+        self.profiler.set_enabled(self.profile or self.hud.visible)
+        self.top().redraw = True
+
+    def export_profile(self) -> None:
+        self.profiler.export_csv(PROFILE_FILENAME + ".csv")
+        self.profiler.export_chrome_trace(PROFILE_FILENAME + ".json")
+        if screen_log.info_on:
+            screen_log.info("profile of %d frames written",
+                            len(self.profiler.frames))
+
+    def key_handler(self, key) -> None:
+        if key == DUMP_LOG_KEY:
+            default_logger.dump()
+        elif key == PROFILER_HUD_KEY:
+            self.toggle_hud()
+        elif key == PROFILE_EXPORT_KEY:
+            self.export_profile()
+
+    def run(self) -> None:
+        profiler = self.profiler
+        while self.screens:
+            events = wait_events() if self.top().idle else pygame.event.get()
+            # Waiting for events or the next frame is not part of a frame
+            profiler.begin_frame()
+            with profiler.section("events"):
+                for event in events:
+                    if event.type == pygame.QUIT:
+                        pygame.quit()
+                        exit()
+                    if event.type == pygame.KEYDOWN:
+                        self.key_handler(event.key)
+                    # A handler can change the top screen, the rest of the
+                    # events go to the new one
+                    if self.screens:
+                        self.top().handle_event(event)
+            if not self.screens:
+                break
+            with profiler.section("update"):
+                self.top().update()
+            screen = self.top()
+            with profiler.section("hud"):
+                self.hud.update()
+            # Tetris picks HUD changes up as a dirty rect, idle screens
+            # only draw when asked to
+            if screen.idle and self.hud.pop_dirty_rect() is not None:
+                screen.redraw = True
+            with profiler.section("render"):
+                screen.render()
+            profiler.end_frame()
+            self.clock.tick(screen.fps)
+
+
+class Screen(object):
+    # Idle screens sleep until there is input and only redraw after it,
+    # others run every frame up to fps (0 is uncapped)
+    idle = True
+    fps = 0
 
-class Menu(object):
     def __init__(self, surface):
-        # Save init params
         self.surface = surface
+        self.stack = None
+        # Profiler HUD of the stack, screens drawn on their own have none
+        self.hud = None
+        self.buttons = []
+        self.redraw = True
+        self.profiler = default_profiler
+
+    def enter(self, stack: ScreenStack) -> None:
+        self.stack = stack
+        self.hud = stack.hud
+        self.redraw = True
+        self.reset()
+
+    def resume(self) -> None:
+        self.redraw = True
+
+    def leave(self) -> None:
+        pass
+
+    def reset(self) -> None:
+        pass
+
+    def handle_event(self, event) -> None:
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            for button in self.buttons:
+                button.check_click(event.pos)
+        self.redraw = self.redraw or event.type not in IDLE_EVENTS
+
+    def update(self) -> None:
+        pass
+
+    def render(self) -> None:
+        if self.redraw:
+            self.redraw = False
+            self.draw()
+
+    def draw(self) -> None:
+        with self.profiler.section("draw"):
+            self.static_layer.render(self.surface)
+            if self.hud is not None:
+                self.hud.render(self.surface)
+        with self.profiler.section("flip"):
+            pygame.display.flip()
+
+
+class Menu(Screen):
+    def __init__(self, surface, prefetch: bool = True):
+        super().__init__(surface)
+        # Save init params
+        self.prefetch = prefetch
         # Initialise additional windows
         self.tetris = Tetris(surface, Tetromino, TETSIS_HS_FILENAME)
         self.pentris = Tetris(surface, Pentomino, PENTIX_HS_FILENAME)
         self.hs = HighScores(surface)
+        self.ai_enabled = False
         # Initialise pygame renderers
         self.background = pygame.sprite.Group()
         PygamePicture((-50, -50), self.background, "menu_background.png")
         self.tetris_start_butt = PygamePushButton((250, 300), (200, 70), 50,
                                                   ColorMap.WHITE, ColorMap.WHITE,
-                                                  5, None, self.tetris.run, "TETRIS")
+                                                  5, None, self.start_tetris, "TETRIS")
         self.pentris_start_butt = PygamePushButton((250, 400), (200, 70), 50,
                                                    ColorMap.WHITE, ColorMap.WHITE,
-                                                   5, None, self.pentris.run, "PENTIX")
+                                                   5, None, self.start_pentris, "PENTIX")
         self.highscores_butt = PygamePushButton((250, 500), (200, 70), 40,
                                                 ColorMap.WHITE, ColorMap.WHITE,
-                                                5, None, self.hs.run, "HIGHSCORES")
+                                                5, None, self.show_highscores, "HIGHSCORES")
         self.exit_butt = PygamePushButton((250, 600), (200, 70), 50,
                                           ColorMap.WHITE, ColorMap.WHITE,
                                           5, None, self.exit, "EXIT")
+        self.ai_butt = PygamePushButton((250, 215), (200, 70), 40,
+                                        ColorMap.WHITE, ColorMap.WHITE,
+                                        5, None, self.toggle_ai, "AI: OFF")
         self.menu_rect = PygameFillingRect(
             (200, 0), (300, 700), ColorMap.CLEAR, 0)
         self.logo = pygame.sprite.Group()
         PygamePicture((200, 0), self.logo, "logo.png", 0.25)
-        # Set fps
-        self.fps = 30
-        # Ininitalize clock
-        self.clock = pygame.time.Clock()
+        self.static_layer = PygameStaticLayer(
+            surface.get_size(),
+            [self.background, self.menu_rect, self.logo, self.ai_butt,
+             self.tetris_start_butt, self.pentris_start_butt,
+             self.highscores_butt, self.exit_butt])
+        self.buttons = [self.tetris_start_butt, self.pentris_start_butt,
+                        self.highscores_butt, self.exit_butt, self.ai_butt]
 
-    def reset(self):
-        self.exit = False
+    def start_tetris(self):
+        self.stack.push(self.tetris)
 
-    def key_handler(self, key):
-        pass
+    def start_pentris(self):
+        self.stack.push(self.pentris)
 
-    def exit(self):
-        self.exit = True
+    def show_highscores(self):
+        self.stack.push(self.hs)
 
-    def render(self):
-        self.surface.fill(ColorMap.CLEAR)
-        self.background.draw(self.surface)
-        self.menu_rect.render(self.surface)
-        self.logo.draw(self.surface)
-        self.tetris_start_butt.render(self.surface)
-        self.pentris_start_butt.render(self.surface)
-        self.highscores_butt.render(self.surface)
-        self.exit_butt.render(self.surface)
-        pygame.display.flip()
-
-    def run(self):
-        self.reset()
-        while True:
-            print("menu")
-            if self.exit:
-                break
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    self.tetris_start_butt.check_click(event.pos)
-                    self.pentris_start_butt.check_click(event.pos)
-                    self.highscores_butt.check_click(event.pos)
-                    self.exit_butt.check_click(event.pos)
-            self.render()
-            self.clock.tick(self.fps)
-
-
-class Tetris(object):
-    DROP_EVENT = pygame.USEREVENT + 1
-
-    def __init__(self, surface, piece_type, highscore_filename):
+    def exit(self):
+        self.stack.pop()
+
+    def toggle_ai(self):
+        self.ai_enabled = not self.ai_enabled
+        self.tetris.set_ai(self.ai_enabled)
+        self.pentris.set_ai(self.ai_enabled)
+        self.ai_butt.set_text("AI: ON" if self.ai_enabled else "AI: OFF")
+        self.static_layer.invalidate()
+        self.redraw = True
+
+    def draw(self):
+        super().draw()
+        if self.prefetch:
+            # Game assets load while the first menu frame is shown
+            self.prefetch = False
+            default_assets.prefetch(GAME_IMAGES, GAME_SOUNDS)
+
+
+class Tetris(Screen):
+    idle = False
+
+    KEY_ACTIONS = {
+        pygame.K_RIGHT: Action.RIGHT,
+        pygame.K_LEFT: Action.LEFT,
+        pygame.K_UP: Action.ROTATE_CW,
+        pygame.K_x: Action.ROTATE_CW,
+        pygame.K_SPACE: Action.HARD_DROP,
+        pygame.K_DOWN: Action.SOFT_DROP,
+        pygame.K_LCTRL: Action.ROTATE_CCW,
+        pygame.K_RCTRL: Action.ROTATE_CCW,
+        pygame.K_z: Action.ROTATE_CCW,
+        pygame.K_LSHIFT: Action.HOLD,
+        pygame.K_RSHIFT: Action.HOLD,
+        pygame.K_c: Action.HOLD
+    }
+    # Hidden rows above the screen still drawn for pieces entering it
+    VIEW_MARGIN = 2
+
+    def __init__(self, surface, piece_type, highscore_filename,
+                 ai_time_budget=0.1, dirty_rendering=True, fps=60):
+        super().__init__(surface)
         # Save init params
-        self.surface = surface
         self.piece_type = piece_type
         self.highscore_filename = highscore_filename
+        self.ai_time_budget = ai_time_budget
+        self.dirty_rendering = dirty_rendering
+        # AI player is started on first use
+        self.ai_enabled = False
+        self.ai_player = None
         # Initialise additional windows
         self.pause_screen = Pause(surface, self)
         self.gameover_screen = GameOver(surface, self)
-        # Initialise board
-        self.board = TetrisBoard(ColorMap.CLEAR)
+        # Frame rate cap, 0 renders as fast as possible. Game logic always
+        # runs at TICK_RATE
+        self.fps = fps
+        # Initialise game engine
+        self.engine = TetrisEngine(piece_type, TICK_RATE)
+        self.timestep = FixedTimestep(TICK_RATE)
+        self.board = self.engine.board
         # Innitialize pygame renderers
-        self.board_renderer = PygameTileField(
-            (150, -900), self.board, (40, 40), ColorMap.CLEAR)
+        viewport = surface.get_rect()
+        self.board_renderer = PygameLockedField(
+            (150, -900), self.board, (40, 40), ColorMap.CLEAR,
+            background=ColorMap.BG, viewport=viewport,
+            margin=self.VIEW_MARGIN)
         self.curr_piece_renderer = PygameTetrisPiece(
-            (150, -900), None, (40, 40))
+            (150, -900), None, (40, 40), viewport=viewport,
+            margin=self.VIEW_MARGIN)
         self.ghost_piece_renderer = PygameTetrisPiece(
-            (150, -900), None, (40, 40))
+            (150, -900), None, (40, 40), viewport=viewport,
+            margin=self.VIEW_MARGIN)
         self.next_piece_renderer = PygameTetrisPiece(
             (600, 50), None, (20, 20))
         self.hold_piece_renderer = PygameTetrisPiece(
@@ -152,198 +364,163 @@ class Tetris(object):
         # Initialise bg sprite
         self.background = pygame.sprite.Group()
         PygamePicture((-50, -50), self.background, "game_background.jpg")
-        # Initialize randomzer
-        self.randomizer = RandomBag(piece_type.SHAPES)
-        # Set fps
-        self.fps = 60
-        # Debug
-        self.lock_delay_textbox = PygameTextBox((100, 10), ColorMap.RED, 30)
-        # Initialize clock
-        self.clock = pygame.time.Clock()
-        # Load all sounds
-        self.main_theme = load_sound("main_theme.wav")
-        self.main_theme.set_volume(0.3)
-        self.hold_sound = load_sound("hold.wav")
-        self.hard_drop_sound = load_sound("hard_drop.wav")
-        self.rotate_sound = load_sound("rotate.wav")
-        self.pause_sound = load_sound("pause.wav")
-        self.gameover_sound = load_sound("gameover.wav")
+        self.static_layer = PygameStaticLayer(
+            surface.get_size(),
+            [self.background, self.board_rect, self.score_rect,
+             self.next_piece_rect, self.next_piece_text,
+             self.hold_piece_rect, self.hold_piece_text])
+        self.music = default_music
+        self.audio = default_audio
 
     def reset(self):
-        self.board.reset()
-        self.game_over = False
-        self.score = 0
-        self.level = 1
-        self.combo = 0
-        self.total_lines = 0
-        self.randomizer.shuffle()
-        self.hold_piece = None
-        self.next_piece = self.choose_piece()
-        self.hold_used = False
-        self.hard_drop_used = False
-        self.exit = False
-        self.restart = False
-        self.board.new_piece(self.choose_piece())
-        pygame.time.set_timer(self.DROP_EVENT, self.level_delay())
-        self.lock_delay_frames = 0
-        self.main_theme.play(-1)
-
-    def hold(self):
-        if self.hold_used:
-            return
-        self.hold_sound.play()
-        self.clock.tick(5)
-        self.hold_used = True
-        if self.hold_piece is None:
-            self.hold_piece = self.board.get_curr_piece()
-            self.board.new_piece(self.next_piece)
-            self.next_piece = self.choose_piece()
-        else:
-            new_hold_piece = self.board.get_curr_piece()
-            self.board.new_piece(self.hold_piece)
-            self.hold_piece = new_hold_piece
-        self.hold_piece.set_coords((0, 0))
-        self.hold_piece_renderer.set_piece(self.hold_piece)
+        self.engine.reset()
+        self.timestep.reset()
+        self.actions = []
+        self.hold_piece_renderer.set_piece(None)
+        self.update_labels()
+        self.full_redraw = True
+        self.dirty_rects = []
+        self.ai_piece = None
+        if self.ai_enabled and self.ai_player is None:
+            self.ai_player = AIPlayer(self.piece_type, self.ai_time_budget)
+        self.music.play(MAIN_THEME, 0.3)
+
+    def resume(self):
+        # Time spent under another screen is not played back
+        self.full_redraw = True
+        self.timestep.reset()
+
+    def set_ai(self, enabled):
+        self.ai_enabled = enabled
+
+    def ai_handler(self):
+        # Asks the search worker about every new piece and plays its
+        # answer as soon as it arrives, without blocking the frame
+        piece = self.board.get_curr_piece()
+        if piece is not self.ai_piece and not self.engine.game_over:
+            self.ai_piece = piece
+            self.ai_player.request(self.engine)
+        actions = self.ai_player.poll()
+        if actions is not None:
+            self.actions.extend(actions)
 
     def key_handler(self, key):
-        if key == pygame.K_RIGHT:
-            self.board.horiz_move_curr_piece(True)
-        elif key == pygame.K_LEFT:
-            self.board.horiz_move_curr_piece(False)
-        elif key in (pygame.K_UP, pygame.K_x):
-            self.board.rotate_curr_piece(True)
-        elif key == pygame.K_SPACE:
-            self.hard_drop_sound.play()
-            self.clock.tick(10)
-            self.board.hard_drop_curr_piece()
-            self.lock_delay_frames = self.fps
-        elif key == pygame.K_DOWN:
-            self.board.drop_curr_piece()
-        elif key in (pygame.K_LCTRL, pygame.K_RCTRL, pygame.K_z):
-            self.board.rotate_curr_piece(False)
+        if key in self.KEY_ACTIONS:
+            if not self.ai_enabled:
+                self.actions.append(self.KEY_ACTIONS[key])
         elif key in (pygame.K_ESCAPE, pygame.K_F1):
-            self.pause_sound.play()
-            self.clock.tick(5)
-            self.pause_screen.run()
-        elif key in (pygame.K_LSHIFT, pygame.K_RSHIFT, pygame.K_c):
-            self.hold()
-
-    def score_counter(self, cleared_rows):
-        if cleared_rows == 0:
-            self.combo = 0
-        elif cleared_rows == 1:
-            self.score += 100 * self.level
-            self.total_lines += 1
-        elif cleared_rows == 2:
-            self.score += 300 * self.level
-            self.total_lines += 3
-        elif cleared_rows == 3:
-            self.score += 500 * self.level
-            self.total_lines += 5
-        elif cleared_rows == 4:
-            self.score += 800 * self.level
-            self.total_lines += 8
-        if self.combo > 1:
-            self.score += self.combo * self.level + 50 * self.level
-        if self.total_lines >= self.level * 5:
-            self.total_lines = 0
-            self.level += 1
-            pygame.time.set_timer(self.DROP_EVENT, self.level_delay())
-        self.score_textbox.set_text(f"Score: {self.score}")
-        self.level_textbox.set_text(f"Level: {self.level}")
+            self.audio.play("pause.wav")
+            self.stack.push(self.pause_screen)
+
+    def event_handler(self, event):
+        if event == GameEvent.HOLD:
+            self.audio.play("hold.wav")
+            self.hold_piece_renderer.set_piece(self.engine.hold_piece)
+        elif event == GameEvent.HARD_DROP:
+            self.audio.play("hard_drop.wav")
+        elif event == GameEvent.LOCK:
+            self.update_labels()
+
+    def update_labels(self):
+        self.score_textbox.set_text(f"Score: {self.engine.score}")
+        self.level_textbox.set_text(f"Level: {self.engine.level}")
+
+    def collect_dirty_rects(self):
+        # Every renderer that can change reports the area it touched
+        rects = self.dirty_rects
+        self.dirty_rects = []
+        renderers = [self.board_renderer,
+                     self.ghost_piece_renderer, self.curr_piece_renderer,
+                     self.next_piece_renderer, self.hold_piece_renderer,
+                     self.score_textbox, self.level_textbox]
+        if self.hud is not None:
+            renderers.append(self.hud)
+        for renderer in renderers:
+            rect = renderer.pop_dirty_rect()
+            if rect is not None:
+                rects.append(rect)
+        return merge_rects(rects)
 
     def render(self):
-        self.surface.fill(ColorMap.CLEAR)
-        self.background.draw(self.surface)
-        self.board_rect.render(self.surface)
-        self.score_rect.render(self.surface)
-        self.next_piece_rect.render(self.surface)
-        self.next_piece_text.render(self.surface)
-        self.hold_piece_rect.render(self.surface)
-        self.hold_piece_text.render(self.surface)
-        self.board_renderer.render(self.surface)
-        self.ghost_piece_renderer.render(self.surface)
-        self.curr_piece_renderer.render(self.surface)
-        self.next_piece_renderer.render(self.surface)
-        self.hold_piece_renderer.render(self.surface)
-        self.score_textbox.render(self.surface)
-        self.level_textbox.render(self.surface)
-        # Debug
-        # self.lock_delay_textbox.render(self.surface)
-        pygame.display.flip()
-
-    def level_delay(self):
-        return round(700 / sqrt(self.level))
-
-    def choose_piece(self):
-        return self.piece_type((0, 0), *next(self.randomizer))
-
-    def run(self):
+        # Only the changed regions are redrawn and pushed to the display,
+        # screen transitions fall back to a full redraw
+        profiler = self.profiler
+        dirty_rects = self.collect_dirty_rects()
+        if self.full_redraw or not self.dirty_rendering:
+            self.full_redraw = False
+            self.draw()
+            with profiler.section("flip"):
+                pygame.display.flip()
+        elif dirty_rects:
+            for rect in dirty_rects:
+                self.surface.set_clip(rect)
+                self.draw()
+            self.surface.set_clip(None)
+            with profiler.section("flip"):
+                pygame.display.update(dirty_rects)
+
+    def draw(self):
+        profiler = self.profiler
+        with profiler.section("draw.static"):
+            self.static_layer.render(self.surface)
+        with profiler.section("draw.board"):
+            self.board_renderer.render(self.surface)
+        with profiler.section("draw.pieces"):
+            self.ghost_piece_renderer.render(self.surface)
+            self.curr_piece_renderer.render(self.surface)
+            self.next_piece_renderer.render(self.surface)
+            self.hold_piece_renderer.render(self.surface)
+        with profiler.section("draw.text"):
+            self.score_textbox.render(self.surface)
+            self.level_textbox.render(self.surface)
+        if self.hud is not None:
+            self.hud.render(self.surface)
+
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            self.key_handler(event.key)
+
+    def update(self):
+        if self.engine.game_over:
+            self.music.stop()
+            self.audio.play("gameover.wav")
+            self.stack.push(self.gameover_screen)
+            return
+        profiler = self.profiler
+        if self.ai_enabled:
+            with profiler.section("ai"):
+                self.ai_handler()
+        # Logic runs at the fixed tick rate, input waits for the next
+        # tick when frames come faster than ticks
+        with profiler.section("logic"):
+            for _ in range(self.timestep.advance()):
+                for event in self.engine.step(self.actions):
+                    self.event_handler(event)
+                self.actions.clear()
+        if log.debug_on:
+            log.debug("lock delay ticks %d", self.engine.lock_delay_ticks)
+        if profiler.enabled:
+            profiler.counters["lock delay"] = self.engine.lock_delay_ticks
+        self.curr_piece_renderer.set_piece(self.board.get_curr_piece())
+        with profiler.section("ghost"):
+            self.ghost_piece_renderer.set_piece(self.engine.get_ghost_piece())
+        self.next_piece_renderer.set_piece(self.engine.next_piece)
+
+    def exit_game(self):
+        self.music.stop()
+        self.save_score()
+        self.stack.pop()
+
+    def restart_game(self):
+        self.music.stop()
+        self.save_score()
         self.reset()
-        falling = False
-        while True:
-            print("game")
-            if self.exit:
-                self.main_theme.stop()
-                self.save_score()
-                break
-            elif self.restart:
-                self.main_theme.stop()
-                self.save_score()
-                self.reset()
-            elif self.game_over:
-                self.main_theme.stop()
-                self.gameover_sound.play()
-                self.gameover_screen.run()
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == self.DROP_EVENT:
-                    self.board.drop_curr_piece()
-                elif event.type == pygame.KEYDOWN:
-                    self.key_handler(event.key)
-            if self.board.check_lock_delay():
-                self.lock_delay_frames += 1
-            else:
-                self.lock_delay_frames = 0
-                falling = True
-            print(f"FD: {self.board.check_lock_delay()}")
-            print(f"Falling: {falling}")
-            print(f"LD frames: {self.lock_delay_frames}")
-            if self.lock_delay_frames >= self.fps // 2:
-                self.hold_used = False
-                self.lock_delay_frames = 0
-                self.board.put_curr_piece()
-                self.board.clear_filled_rows(self.score_counter)
-                self.next_piece.set_coords((4, 21))
-                if self.board.piece_collides_tiles(self.next_piece):
-                    self.game_over = True
-                self.board.new_piece(self.next_piece)
-                self.next_piece = self.choose_piece()
-                print("Next piece")
-            curr_piece = self.board.get_curr_piece()
-            self.curr_piece_renderer.set_piece(curr_piece)
-            ghost_piece = self.board.get_ghost_piece()
-            self.ghost_piece_renderer.set_piece(ghost_piece)
-            self.next_piece_renderer.set_piece(self.next_piece)
-            # Debug
-            self.lock_delay_textbox.set_text(str(self.lock_delay_frames))
-            # Debug end
-            self.render()
-            self.clock.tick(self.fps)
-
-    def set_exit_flag(self):
-        self.exit = True
-
-    def set_restart_flag(self):
-        self.restart = True
 
     def get_score(self):
-        return self.score
+        return self.engine.get_score()
 
     def get_level(self):
-        return self.level
+        return self.engine.get_level()
 
     def save_score(self):
         if os.path.isfile(self.highscore_filename):
@@ -355,16 +532,17 @@ class Tetris(object):
                 h_score, h_level = 0, 0
         else:
             h_score, h_level = 0, 0
-        print(h_score, h_level)
-        h_score = max(h_score, self.score)
-        h_level = max(h_level, self.level)
+        if log.info_on:
+            log.info("previous best score %d level %d", h_score, h_level)
+        h_score = max(h_score, self.engine.score)
+        h_level = max(h_level, self.engine.level)
         with open(self.highscore_filename, "w") as f:
             f.write(f"{h_score} {h_level}")
 
 
-class Pause(object):
+class Pause(Screen):
     def __init__(self, surface, game_field):
-        self.surface = surface
+        super().__init__(surface)
         self.game_field = game_field
         self.resume_butt = PygamePushButton((250, 300), (200, 70), 50,
                                             ColorMap.WHITE, ColorMap.WHITE,
@@ -377,58 +555,27 @@ class Pause(object):
                                              5, None, self.restart_game, "Restart")
         self.pause_pic = pygame.sprite.Group()
         PygamePicture((-76, -100), self.pause_pic, "pause.jpg")
-        self.fps = 30
-        self.clock = pygame.time.Clock()
-
-    def render(self):
-        self.surface.fill(ColorMap.CLEAR)
-        self.pause_pic.draw(self.surface)
-        self.resume_butt.render(self.surface)
-        self.exit_butt.render(self.surface)
-        self.restart_butt.render(self.surface)
-        pygame.display.flip()
+        self.static_layer = PygameStaticLayer(
+            surface.get_size(),
+            [self.pause_pic, self.resume_butt, self.exit_butt,
+             self.restart_butt])
+        self.buttons = [self.resume_butt, self.exit_butt, self.restart_butt]
 
     def resume_game(self):
-        self.exit = True
+        self.stack.pop()
 
     def exit_game(self):
-        self.exit_game = True
-        self.exit = True
+        self.stack.pop()
+        self.game_field.exit_game()
 
     def restart_game(self):
-        self.restart_game = True
-        self.exit = True
+        self.stack.pop()
+        self.game_field.restart_game()
 
-    def reset(self):
-        self.restart_game = False
-        self.exit_game = False
-        self.exit = False
 
-    def run(self):
-        self.reset()
-        while True:
-            print("paused")
-            if self.exit:
-                break
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    self.resume_butt.check_click(event.pos)
-                    self.exit_butt.check_click(event.pos)
-                    self.restart_butt.check_click(event.pos)
-            self.render()
-            self.clock.tick(self.fps)
-        if self.exit_game:
-            self.game_field.set_exit_flag()
-        elif self.restart_game:
-            self.game_field.set_restart_flag()
-
-
-class GameOver(object):
+class GameOver(Screen):
     def __init__(self, surface, game_field):
-        self.surface = surface
+        super().__init__(surface)
         self.game_field = game_field
         self.exit_butt = PygamePushButton((250, 500), (200, 70), 50,
                                           ColorMap.WHITE, ColorMap.WHITE,
@@ -439,57 +586,29 @@ class GameOver(object):
         self.score_textbox = PygameTextBox((250, 290), ColorMap.WHITE, 50, "0")
         self.gameover_pic = pygame.sprite.Group()
         PygamePicture((-76, -100), self.gameover_pic, "gameover.jpg")
-        self.fps = 30
-        self.clock = pygame.time.Clock()
-
-    def render(self):
-        self.surface.fill(ColorMap.CLEAR)
-        self.gameover_pic.draw(self.surface)
-        self.exit_butt.render(self.surface)
-        self.restart_butt.render(self.surface)
-        self.score_textbox.render(self.surface)
-        pygame.display.flip()
+        self.static_layer = PygameStaticLayer(
+            surface.get_size(),
+            [self.gameover_pic, self.exit_butt, self.restart_butt,
+             self.score_textbox])
+        self.buttons = [self.exit_butt, self.restart_butt]
 
     def exit_game(self):
-        self.exit_game = True
-        self.exit = True
+        self.stack.pop()
+        self.game_field.exit_game()
 
     def restart_game(self):
-        self.restart_game = True
-        self.exit = True
+        self.stack.pop()
+        self.game_field.restart_game()
 
     def reset(self):
-        self.restart_game = False
-        self.exit_game = False
-        self.exit = False
         self.score_textbox.set_text(
             "Score: " + str(self.game_field.get_score()))
+        self.static_layer.invalidate()
 
-    def run(self):
-        self.reset()
-        while True:
-            print("gameover")
-            if self.exit:
-                break
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    self.exit_butt.check_click(event.pos)
-                    self.restart_butt.check_click(event.pos)
-            self.render()
-            self.clock.tick(self.fps)
-        if self.exit_game:
-            self.game_field.set_exit_flag()
-        elif self.restart_game:
-            self.game_field.set_restart_flag()
-
-
-class HighScores(object):
+
+class HighScores(Screen):
     def __init__(self, surface):
-        # Save init params
-        self.surface = surface
+        super().__init__(surface)
         # Create renderers
         self.tetris_highscore_textbox = PygameTextBox(
             (0, 0), ColorMap.WHITE, 50)
@@ -502,50 +621,30 @@ class HighScores(object):
         self.exit_butt = PygamePushButton((250, 400), (200, 70), 70,
                                           ColorMap.WHITE, ColorMap.WHITE,
                                           5, None, self.window_exit, "Exit")
-        # Set fps
-        self.fps = 15
-        # Initialise clock
-        self.clock = pygame.time.Clock()
+        self.static_layer = PygameStaticLayer(
+            surface.get_size(),
+            [self.tetris_highscore_textbox, self.tetris_highlevel_textbox,
+             self.pentix_highscore_textbox, self.pentix_highlevel_textbox,
+             self.exit_butt])
+        self.buttons = [self.exit_butt]
 
     def window_exit(self):
-        self.exit = True
-
-    def render(self):
-        self.surface.fill(ColorMap.CLEAR)
-        self.tetris_highscore_textbox.render(self.surface)
-        self.tetris_highlevel_textbox.render(self.surface)
-        self.pentix_highscore_textbox.render(self.surface)
-        self.pentix_highlevel_textbox.render(self.surface)
-        self.exit_butt.render(self.surface)
-        pygame.display.flip()
+        self.stack.pop()
 
     def reset(self):
-        self.exit = False
         h_score, h_level = load_highscores(TETSIS_HS_FILENAME)
         self.tetris_highscore_textbox.set_text(f"Tetris highscore: {h_score}")
         self.tetris_highlevel_textbox.set_text(f"Tetris max level: {h_level}")
         h_score, h_level = load_highscores(PENTIX_HS_FILENAME)
         self.pentix_highscore_textbox.set_text(f"Pentix highscore: {h_score}")
         self.pentix_highlevel_textbox.set_text(f"Pentix max level: {h_level}")
-
-    def run(self):
-        self.reset()
-        while True:
-            print("highscores")
-            if self.exit:
-                break
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    self.exit_butt.check_click(event.pos)
-            self.render()
-            self.clock.tick(self.fps)
+        self.static_layer.invalidate()
 
 
 def main():
-    window = GameWindow((700, 700))
+    window = GameWindow((700, 700),
+                        log_levels=os.environ.get("TETRIS_LOG", ""),
+                        profile=bool(os.environ.get("TETRIS_PROFILE")))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+from collections import deque
+from time import perf_counter
+import json
+import csv
+
+
+class ProfileSection(object):
+    # Reusable context manager timing one named part of a frame
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.name, self.start, perf_counter())
+
+
+class NullSection(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SECTION = NullSection()
+
+
+class FrameProfiler(object):
+    # Timings of named sections for the last window frames. A frame is the
+    # work between begin_frame() and end_frame(), waiting for the next
+    # frame or for input is left out
+    def __init__(self, window: int = 600, enabled: bool = False):
+        self.frames = deque(maxlen=window)
+        self.enabled = enabled
+        self.sections = {}
+        # Values shown next to the timings, like lock delay ticks
+        self.counters = {}
+        self.frame_start = None
+        self.frame_sections = []
+        self.frame_count = 0
+
+    def set_enabled(self, enabled: bool) -> None:
+        self.enabled = enabled
+        self.frame_start = None
+
+    def section(self, name: str):
+        if not self.enabled:
+            return NULL_SECTION
+        if name not in self.sections:
+            self.sections[name] = ProfileSection(self, name)
+        return self.sections[name]
+
+    def begin_frame(self) -> None:
+        if self.enabled:
+            self.frame_start = perf_counter()
+            self.frame_sections = []
+
+    def add(self, name: str, start: float, end: float) -> None:
+        if self.frame_start is not None:
+            self.frame_sections.append((name, start, end - start))
+
+    def end_frame(self) -> None:
+        if self.frame_start is None:
+            return
+        self.frames.append((self.frame_start,
+                            perf_counter() - self.frame_start,
+                            self.frame_sections))
+        self.frame_start = None
+        self.frame_count += 1
+
+    def frame_times(self) -> list:
+        return [duration for _, duration, _ in self.frames]
+
+    def percentiles(self, points=(50, 95, 99)) -> tuple:
+        # Nearest rank percentiles of the frame time, in seconds
+        times = sorted(self.frame_times())
+        if not times:
+            return tuple(0.0 for _ in points)
+        return tuple(times[min(len(times) - 1, len(times) * point // 100)]
+                     for point in points)
+
+    def section_means(self) -> dict:
+        # Mean seconds per frame spent in every section
+        totals = {}
+        for _, _, sections in self.frames:
+            for name, _, duration in sections:
+                totals[name] = totals.get(name, 0.0) + duration
+        return {name: total / len(self.frames)
+                for name, total in totals.items()}
+
+    def export_csv(self, filename: str) -> None:
+        # One row per frame, section columns hold the time summed over
+        # the frame, all in milliseconds
+        names = sorted({name for _, _, sections in self.frames
+                        for name, _, _ in sections})
+        with open(filename, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "start", "total"] + names)
+            first = self.frame_count - len(self.frames)
+            for index, (start, total, sections) in enumerate(self.frames):
+                row = dict.fromkeys(names, 0.0)
+                for name, _, duration in sections:
+                    row[name] += duration
+                writer.writerow([first + index, f"{start * 1000:.3f}",
+                                 f"{total * 1000:.3f}"] +
+                                [f"{row[name] * 1000:.3f}" for name in names])
+
+    def export_chrome_trace(self, filename: str) -> None:
+        # Complete ("X") events in microseconds, for chrome://tracing or
+        # Perfetto
+        events = []
+        for start, total, sections in self.frames:
+            events.append({"name": "frame", "ph": "X", "pid": 0, "tid": 0,
+                           "ts": start * 1e6, "dur": total * 1e6})
+            for name, section_start, duration in sections:
+                events.append({"name": name, "ph": "X", "pid": 0, "tid": 0,
+                               "ts": section_start * 1e6,
+                               "dur": duration * 1e6})
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events,
+                       "displayTimeUnit": "ms"}, f)
+
+
+default_profiler = FrameProfiler()
@@ -1,58 +1,345 @@
 from typing import Iterable
+from collections import OrderedDict
 import pygame
 from core import TetrisPiece, TetrisBoard, ColorMap, Tetromino
-import os
+from assets import AssetManager, default_assets
+import re
 
+# Digits are split into single characters, anything else into whole runs
+TEXT_RUNS = re.compile(r"\d|\D+")
 
-def load_image(name, colorkey=None):
-    fullname = os.path.join('data/images', name)
-    image = pygame.image.load(fullname).convert()
-    return image
+
+def merge_rects(rects: list) -> list:
+    # Unions overlapping rects until none of the results overlap
+    merged = []
+    for rect in rects:
+        rect = pygame.Rect(rect)
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+class TileAtlas(object):
+    # One pre-rendered, display-converted surface per color and tile size,
+    # so drawing a cell is a plain blit
+    def __init__(self, bevel: int = 0):
+        self.bevel = bevel
+        self.tiles = {}
+
+    def get_tile(self, color, tile_size: tuple):
+        key = (tuple(color), tuple(tile_size))
+        if key not in self.tiles:
+            self.tiles[key] = self._prepare(color, tile_size)
+        return self.tiles[key]
+
+    def _prepare(self, color, tile_size: tuple):
+        tile = pygame.Surface(tile_size).convert()
+        tile.fill(color)
+        if self.bevel:
+            color = pygame.Color(color)
+            light = color.lerp(ColorMap.WHITE, 0.4)
+            dark = color.lerp(ColorMap.CLEAR, 0.4)
+            width, height = tile_size
+            for i in range(self.bevel):
+                pygame.draw.line(tile, light, (i, i), (width - 1 - i, i))
+                pygame.draw.line(tile, light, (i, i), (i, height - 1 - i))
+                pygame.draw.line(tile, dark, (i, height - 1 - i),
+                                 (width - 1 - i, height - 1 - i))
+                pygame.draw.line(tile, dark, (width - 1 - i, i),
+                                 (width - 1 - i, height - 1 - i))
+        return tile
+
+
+default_atlas = TileAtlas()
+
+
+class FontRegistry(object):
+    # One pygame.font.Font per (font file, size), shared by every widget
+    def __init__(self):
+        self.fonts = {}
+
+    def get_font(self, font, size: int):
+        key = (font, size)
+        if key not in self.fonts:
+            self.fonts[key] = pygame.font.Font(font, size)
+        return self.fonts[key]
+
+
+class TextCache(object):
+    # Bounded LRU of rendered text surfaces keyed by (text, color, size,
+    # font), so unchanged text is never rendered twice
+    def __init__(self, fonts: FontRegistry, capacity: int = 256):
+        self.fonts = fonts
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+
+    def render(self, text: str, color, size: int, font=None):
+        key = (text, tuple(color), size, font)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            return surface
+        surface = self.fonts.get_font(font, size).render(text, 1, color)
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.capacity:
+            self.surfaces.popitem(last=False)
+        return surface
+
+    def compose(self, text: str, color, size: int, font=None):
+        # Text with digits is put together from cached runs and digit
+        # glyphs, so a changing number never goes through the font renderer
+        runs = TEXT_RUNS.findall(text)
+        if len(runs) < 2:
+            return self.render(text, color, size, font)
+        runs = [self.render(run, color, size, font) for run in runs]
+        height = self.fonts.get_font(font, size).get_height()
+        surface = pygame.Surface((sum(run.get_width() for run in runs),
+                                  height), pygame.SRCALPHA)
+        x = 0
+        for run in runs:
+            # Glyphs never overlap, so max keeps their alpha untouched
+            surface.blit(run, (x, 0), special_flags=pygame.BLEND_RGBA_MAX)
+            x += run.get_width()
+        return surface
+
+
+default_fonts = FontRegistry()
+default_text_cache = TextCache(default_fonts)
+
+
+def visible_rows(top: int, tile_h: int, viewport, margin: int = 0,
+                 rows: int = None) -> range:
+    # Rows of a field drawn from top that overlap viewport, plus margin
+    # rows above it
+    first = max(0, (viewport.top - top) // tile_h - margin)
+    last = -(-(viewport.bottom - top) // tile_h)
+    if rows is not None:
+        last = min(rows, last)
+    return range(first, max(first, last))
 
 
 class PygameTileField(object):
-    def __init__(self, coords: tuple, field, tile_size: tuple, clear_val):
+    def __init__(self, coords: tuple, field, tile_size: tuple, clear_val,
+                 atlas: TileAtlas = default_atlas, viewport=None,
+                 margin: int = 0):
         self.coords = coords
         self.tile_size = tile_size
         self.field = field
         self.clear_val = clear_val
+        self.atlas = atlas
+        self.set_viewport(viewport, margin)
+
+    def set_viewport(self, viewport, margin: int = 0) -> None:
+        # Only rows inside the viewport rect (screen coordinates) are
+        # iterated and drawn, margin keeps a few hidden rows above it
+        self.viewport = viewport
+        self.margin = margin
+        height = self.field.get_size()[1]
+        if viewport is None:
+            self.rows = range(height)
+        else:
+            self.rows = visible_rows(self.coords[1], self.tile_size[1],
+                                     pygame.Rect(viewport), margin, height)
+
+    def get_rect(self):
+        field_size = self.field.get_size()
+        return pygame.Rect(self.coords, (field_size[0] * self.tile_size[0],
+                                         field_size[1] * self.tile_size[1]))
+
+    def get_view_rect(self):
+        # Part of get_rect() covered by the drawn rows
+        tile_w, tile_h = self.tile_size
+        return pygame.Rect(self.coords[0],
+                           self.coords[1] + self.rows.start * tile_h,
+                           self.field.get_size()[0] * tile_w,
+                           len(self.rows) * tile_h)
 
     def render(self, surface, render_border=False):
-        for x, row in enumerate(self.field.get_tiles()):
-            for y, tile_color in enumerate(row):
+        self.draw_tiles(surface, self.coords)
+        if render_border:
+            pygame.draw.rect(surface, ColorMap.WHITE, self.get_rect(), 1)
+
+    def draw_tiles(self, surface, origin: tuple, rows: range = None) -> None:
+        # origin is where row 0 would be drawn
+        rows = self.rows if rows is None else rows
+        tile_w, tile_h = self.tile_size
+        left, top = origin
+        get_tile = self.atlas.get_tile
+        blits = []
+        for x, column in enumerate(self.field.get_tiles()):
+            for y, tile_color in enumerate(column[rows.start:rows.stop],
+                                           rows.start):
                 if tile_color == self.clear_val:
                     continue
-                tile_rect = pygame.Rect(x * self.tile_size[0] + self.coords[0],
-                                        y * self.tile_size[1] +
-                                        self.coords[1],
-                                        self.tile_size[0], self.tile_size[1])
-                pygame.draw.rect(surface, tile_color, tile_rect)
+                blits.append((get_tile(tile_color, self.tile_size),
+                              (x * tile_w + left, y * tile_h + top)))
+        surface.blits(blits, False)
+
+
+class PygameLockedField(PygameTileField):
+    # Keeps the locked stack on its own surface, updated from the board
+    # change notifications instead of walking every cell each frame.
+    # With a background the surface is opaque, which blits much faster
+    # than a colorkeyed one. The surface only covers the viewport rows
+    def __init__(self, coords: tuple, field: TetrisBoard, tile_size: tuple,
+                 clear_val, atlas: TileAtlas = default_atlas,
+                 background=None, viewport=None, margin: int = 0):
+        self.background = clear_val if background is None else background
+        self.surface = None
+        self.dirty_rect = None
+        super().__init__(coords, field, tile_size, clear_val, atlas,
+                         viewport, margin)
+        field.add_listener(self)
+
+    def set_viewport(self, viewport, margin: int = 0) -> None:
+        super().set_viewport(viewport, margin)
+        self.surface = None
+
+    def _prepare(self):
+        rect = self.get_view_rect()
+        self.surface = pygame.Surface(rect.size).convert()
+        if self.background == self.clear_val:
+            self.surface.set_colorkey(self.clear_val)
+        self.surface.fill(self.background)
+        self.draw_tiles(self.surface,
+                        (0, -self.rows.start * self.tile_size[1]))
+        self.add_dirty_rect(pygame.Rect((0, 0), rect.size))
+
+    def add_dirty_rect(self, rect) -> None:
+        # rect is in field surface coordinates
+        if self.dirty_rect is None:
+            self.dirty_rect = pygame.Rect(rect)
+        else:
+            self.dirty_rect.union_ip(rect)
+
+    def pop_dirty_rect(self):
+        rect = self.dirty_rect
+        self.dirty_rect = None
+        if rect is None:
+            return None
+        return rect.move(self.get_view_rect().topleft)
+
+    def on_tiles_put(self, coords, color) -> None:
+        if self.surface is None:
+            return
+        tile_w, tile_h = self.tile_size
+        tile = None
+        if color != self.clear_val:
+            tile = self.atlas.get_tile(color, self.tile_size)
+        for x, y in coords:
+            if y not in self.rows:
+                continue
+            rect = pygame.Rect(x * tile_w, (y - self.rows.start) * tile_h,
+                               tile_w, tile_h)
+            if tile is None:
+                self.surface.fill(self.background, rect)
+            else:
+                self.surface.blit(tile, rect)
+            self.add_dirty_rect(rect)
+
+    def on_rows_cleared(self, rows) -> None:
+        if self.surface is None:
+            return
+        tile_h = self.tile_size[1]
+        width = self.surface.get_width()
+        first = self.rows.start
+        # Each run of adjacent rows moves everything above it down at once,
+        # top run first so the rows below keep their indices. The stale
+        # rows this leaves at the top are redrawn from the field at the end
+        rows = sorted(row for row in rows if first <= row < self.rows.stop)
+        start = 0
+        while start < len(rows):
+            end = start
+            while end + 1 < len(rows) and rows[end + 1] == rows[end] + 1:
+                end += 1
+            bottom = (rows[end] - first + 1) * tile_h
+            self.surface.set_clip(pygame.Rect(0, 0, width, bottom))
+            self.surface.scroll(0, (end - start + 1) * tile_h)
+            self.surface.set_clip(None)
+            start = end + 1
+        if rows:
+            stale = pygame.Rect(0, 0, width, len(rows) * tile_h)
+            self.surface.fill(self.background, stale)
+            self.draw_tiles(self.surface, (0, -first * tile_h),
+                            range(first, first + len(rows)))
+            self.add_dirty_rect(pygame.Rect(
+                0, 0, width, (rows[-1] - first + 1) * tile_h))
+
+    def on_board_reset(self) -> None:
+        self.surface = None
+
+    def render(self, surface, render_border=False):
+        if self.surface is None:
+            self._prepare()
+        surface.blit(self.surface, self.get_view_rect())
         if render_border:
-            field_size = self.field.get_size()
-            border = pygame.Rect(self.coords,
-                                 (field_size[0] * self.tile_size[0],
-                                  field_size[1] * self.tile_size[1]))
-            pygame.draw.rect(surface, ColorMap.WHITE, border, 1)
+            pygame.draw.rect(surface, ColorMap.WHITE, self.get_rect(), 1)
 
 
 class PygameTetrisPiece(object):
-    def __init__(self, coords: tuple, piece: TetrisPiece, tile_size: tuple):
+    def __init__(self, coords: tuple, piece: TetrisPiece, tile_size: tuple,
+                 atlas: TileAtlas = default_atlas, viewport=None,
+                 margin: int = 0):
         self.coords = coords
         self.piece = piece
         self.tile_size = tile_size
+        self.atlas = atlas
+        self.drawn_state = None
+        self.drawn_rect = None
+        self.set_viewport(viewport, margin)
+
+    def set_viewport(self, viewport, margin: int = 0) -> None:
+        # Same culling as PygameTileField, tiles outside are skipped
+        self.viewport = viewport
+        self.rows = None
+        if viewport is not None:
+            self.rows = visible_rows(self.coords[1], self.tile_size[1],
+                                     pygame.Rect(viewport), margin)
 
     def set_piece(self, piece: TetrisPiece):
         self.piece = piece
 
+    def get_rect(self):
+        if self.piece is None:
+            return None
+        tiles = self.piece.get_tiles_coords()
+        left = min(x for x, _ in tiles)
+        top = min(y for _, y in tiles)
+        right = max(x for x, _ in tiles) + 1
+        bottom = max(y for _, y in tiles) + 1
+        return pygame.Rect(left * self.tile_size[0] + self.coords[0],
+                           top * self.tile_size[1] + self.coords[1],
+                           (right - left) * self.tile_size[0],
+                           (bottom - top) * self.tile_size[1])
+
+    def pop_dirty_rect(self):
+        # Area to redraw since the last call: where the piece was and is
+        if self.piece is None:
+            state = None
+        else:
+            state = (self.piece.coords, self.piece.rotation,
+                     self.piece.shape, self.piece.color)
+        if state == self.drawn_state:
+            return None
+        rects = [rect for rect in (self.drawn_rect, self.get_rect())
+                 if rect is not None]
+        self.drawn_state = state
+        self.drawn_rect = self.get_rect()
+        return rects[0].unionall(rects[1:]) if rects else None
+
     def render(self, surface) -> None:
         if self.piece is None:
             return
-        color = self.piece.get_color()
-        for x, y in self.piece.get_tiles_coords():
-            tile_rect = pygame.Rect(x * self.tile_size[0] + self.coords[0],
-                                    y * self.tile_size[1] + self.coords[1],
-                                    self.tile_size[0], self.tile_size[1])
-            pygame.draw.rect(surface, color, tile_rect)
+        tile = self.atlas.get_tile(self.piece.get_color(), self.tile_size)
+        tile_w, tile_h = self.tile_size
+        left, top = self.coords
+        rows = self.rows
+        surface.blits([(tile, (x * tile_w + left, y * tile_h + top))
+                       for x, y in self.piece.get_tiles_coords()
+                       if rows is None or y in rows], False)
 
 
 class PygamePushButton(object):
@@ -65,7 +352,8 @@ class PygamePushButton(object):
                  border_width: int,
                  font,
                  action: callable,
-                 text: str = ""):
+                 text: str = "",
+                 text_cache: TextCache = default_text_cache):
         self.coords = coords
         self.size = size
         self.font_size = font_size
@@ -75,12 +363,13 @@ class PygamePushButton(object):
         self.font = font
         self.action = action
         self.text = text
+        self.text_cache = text_cache
         self._prepare()
 
     def _prepare(self):
         self.rect = pygame.Rect(self.coords, self.size)
-        font = pygame.font.Font(self.font, self.font_size)
-        self.pygame_text = font.render(self.text, 1, self.font_color)
+        self.pygame_text = self.text_cache.render(
+            self.text, self.font_color, self.font_size, self.font)
         text_w = self.pygame_text.get_width()
         text_h = self.pygame_text.get_height()
         self.text_coords = (self.coords[0] + self.size[0] // 2 - text_w // 2,
@@ -96,6 +385,7 @@ class PygamePushButton(object):
 
     def set_text(self, text: str):
         self.text = text
+        self._prepare()
 
     def set_action(self, action: callable):
         self.action = action
@@ -107,35 +397,148 @@ class PygameTextBox(object):
                  color,
                  font_size: int,
                  text: str = "",
-                 font=None):
+                 font=None,
+                 text_cache: TextCache = default_text_cache):
         self.coords = coords
-        self.font = pygame.font.Font(font, font_size)
+        self.font_size = font_size
+        self.font_name = font
+        self.text_cache = text_cache
+        self.font = text_cache.fonts.get_font(font, font_size)
         self.color = color
         self.text = text
+        self.drawn_rect = None
+        self.drawn_text = None
+        self.surface_text = None
 
     def set_text(self, text: str) -> None:
         self.text = text
 
+    def get_surface(self):
+        if self.text != self.surface_text:
+            self.surface_text = self.text
+            self.surface = self.text_cache.compose(
+                self.text, self.color, self.font_size, self.font_name)
+        return self.surface
+
+    def get_rect(self):
+        return pygame.Rect(self.coords, self.get_surface().get_size())
+
+    def pop_dirty_rect(self):
+        if self.text == self.drawn_text:
+            return None
+        rect = self.get_rect()
+        if self.drawn_rect is not None:
+            rect.union_ip(self.drawn_rect)
+        self.drawn_text = self.text
+        self.drawn_rect = self.get_rect()
+        return rect
+
     def render(self, surface, render_border: bool = False) -> None:
-        text = self.font.render(self.text, 1, self.color)
-        surface.blit(text, self.coords)
+        surface.blit(self.get_surface(), self.coords)
         if render_border:
-            rect = pygame.Rect(
-                self.coords, (text.get_width(), text.get_height()))
-            pygame.draw.rect(surface, ColorMap.WHITE, rect, 1)
+            pygame.draw.rect(surface, ColorMap.WHITE, self.get_rect(), 1)
+
+
+class PygameProfilerHud(object):
+    # Frame time percentiles, the slowest sections and the counters of a
+    # FrameProfiler, refreshed every few profiled frames
+    def __init__(self,
+                 coords: tuple,
+                 profiler,
+                 color=ColorMap.WHITE,
+                 font_size: int = 18,
+                 refresh: int = 30,
+                 sections: int = 8,
+                 text_cache: TextCache = default_text_cache):
+        self.coords = coords
+        self.profiler = profiler
+        self.color = color
+        self.font_size = font_size
+        self.refresh = refresh
+        self.sections = sections
+        self.text_cache = text_cache
+        self.visible = False
+        self.lines = []
+        self.refreshed_at = None
+        self.changed = False
+        self.drawn_rect = None
+
+    def toggle(self) -> None:
+        self.visible = not self.visible
+        self.refreshed_at = None
+        self.changed = True
+
+    def get_lines(self) -> list:
+        profiler = self.profiler
+        lines = ["frame ms p50 %.2f p95 %.2f p99 %.2f" %
+                 tuple(time * 1000 for time in profiler.percentiles())]
+        means = sorted(profiler.section_means().items(),
+                       key=lambda item: item[1], reverse=True)
+        lines += [f"{name} {mean * 1000:.3f}"
+                  for name, mean in means[:self.sections]]
+        lines += [f"{name} {value}"
+                  for name, value in profiler.counters.items()]
+        return lines
+
+    def update(self) -> None:
+        if not self.visible:
+            return
+        frame_count = self.profiler.frame_count
+        if self.refreshed_at is not None and \
+                frame_count - self.refreshed_at < self.refresh:
+            return
+        self.refreshed_at = frame_count
+        self.lines = [self.text_cache.compose(line, self.color,
+                                              self.font_size)
+                      for line in self.get_lines()]
+        self.changed = True
+
+    def get_rect(self):
+        if not self.visible or not self.lines:
+            return None
+        return pygame.Rect(self.coords,
+                           (max(line.get_width() for line in self.lines),
+                            sum(line.get_height() for line in self.lines)))
+
+    def pop_dirty_rect(self):
+        if not self.changed:
+            return None
+        self.changed = False
+        rects = [rect for rect in (self.drawn_rect, self.get_rect())
+                 if rect is not None]
+        self.drawn_rect = self.get_rect()
+        return rects[0].unionall(rects[1:]) if rects else None
+
+    def render(self, surface) -> None:
+        rect = self.get_rect()
+        if rect is None:
+            return
+        surface.fill(ColorMap.CLEAR, rect)
+        left, top = self.coords
+        blits = []
+        for line in self.lines:
+            blits.append((line, (left, top)))
+            top += line.get_height()
+        surface.blits(blits, False)
 
 
 class PygamePicture(pygame.sprite.Sprite):
-    def __init__(self, coords, group, filename, scale: float = 1.0):
+    # The image is only loaded when the sprite is first drawn
+    def __init__(self, coords, group, filename, scale: float = 1.0,
+                 assets: AssetManager = default_assets):
         super().__init__(group)
-        self.image = load_image(filename)
-        if scale != 1.0:
-            x = round(self.image.get_width() * scale)
-            y = round(self.image.get_height() * scale)
-            self.image = pygame.transform.smoothscale(self.image, (x, y))
-        self.rect = self.image.get_rect()
-        self.rect.x = coords[0]
-        self.rect.y = coords[1]
+        self.coords = coords
+        self.filename = filename
+        self.scale = scale
+        self.assets = assets
+
+    @property
+    def image(self):
+        return self.assets.get_image(self.filename, self.scale)
+
+    @property
+    def rect(self):
+        return self.image.get_rect(topleft=self.coords)
 
 
 class PygameFillingRect(object):
@@ -151,3 +554,31 @@ class PygameFillingRect(object):
 
     def render(self, surface):
         pygame.draw.rect(surface, self.color, self.rect, self.border)
+
+
+class PygameStaticLayer(object):
+    # Composites content that rarely changes into one converted surface,
+    # which is rebuilt only after invalidate()
+    def __init__(self, size, items: list, background=ColorMap.CLEAR):
+        self.size = size
+        self.items = items
+        self.background = background
+        self.surface = None
+
+    def invalidate(self) -> None:
+        self.surface = None
+
+    def _prepare(self):
+        self.surface = pygame.Surface(self.size).convert()
+        self.surface.fill(self.background)
+        for item in self.items:
+            # Sprite groups draw, every other renderer renders
+            if isinstance(item, pygame.sprite.Group):
+                item.draw(self.surface)
+            else:
+                item.render(self.surface)
+
+    def render(self, surface):
+        if self.surface is None:
+            self._prepare()
+        surface.blit(self.surface, (0, 0))
@@ -0,0 +1,158 @@
+from core import Tetromino, Pentomino
+from engine import TetrisEngine, Action
+from bot import beam_policy
+from multiprocessing import Pool
+from importlib import import_module
+from random import Random
+from time import perf_counter
+import argparse
+import json
+import csv
+import os
+
+PIECE_TYPES = {"tetris": Tetromino, "pentix": Pentomino}
+RESULT_FIELDS = ("game", "mode", "seed", "score", "level", "lines",
+                 "pieces", "ticks", "duration")
+
+
+def random_policy(engine, rng):
+    # Random rotation and column, then hard drop
+    actions = [Action.ROTATE_CW] * rng.randrange(4)
+    shift = rng.randrange(-5, 6)
+    actions += [Action.RIGHT if shift > 0 else Action.LEFT] * abs(shift)
+    actions.append(Action.HARD_DROP)
+    return actions
+
+
+def idle_policy(engine, rng):
+    return ()
+
+
+POLICIES = {"random": random_policy, "idle": idle_policy,
+            "beam": beam_policy}
+
+
+def load_policy(name):
+    # Either a builtin name or "module:function", called once per piece
+    # with (engine, rng) and returning the actions to play for that piece
+    if name in POLICIES:
+        return POLICIES[name]
+    module, function = name.split(":")
+    return getattr(import_module(module), function)
+
+
+def play_game(mode, game, seed, policy, max_pieces):
+    engine = TetrisEngine(PIECE_TYPES[mode], seed=seed)
+    rng = Random(seed)
+    start = perf_counter()
+    while not engine.game_over and engine.pieces < max_pieces:
+        pieces = engine.pieces
+        actions = iter(policy(engine, rng))
+        while engine.pieces == pieces and not engine.game_over:
+            action = next(actions, None)
+            engine.step(() if action is None else (action,))
+    return {"game": game, "mode": mode, "seed": seed,
+            "score": engine.score, "level": engine.level,
+            "lines": engine.lines, "pieces": engine.pieces,
+            "ticks": engine.ticks,
+            "duration": round(perf_counter() - start, 6)}
+
+
+def play_chunk(task):
+    mode, games, base_seed, policy_name, max_pieces = task
+    policy = load_policy(policy_name)
+    return [play_game(mode, game, base_seed + game, policy, max_pieces)
+            for game in games]
+
+
+class ResultWriter(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.jsonl = filename.endswith(".jsonl")
+
+    def load_finished(self) -> set:
+        # Finished (mode, game) pairs, a line cut by an interruption is
+        # dropped so the file can be appended to again
+        finished = set()
+        if not os.path.isfile(self.filename):
+            return finished
+        with open(self.filename, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+        with open(self.filename, newline="") as f:
+            if self.jsonl:
+                rows = (json.loads(line) for line in f if line.strip())
+            else:
+                rows = csv.DictReader(f)
+            for row in rows:
+                finished.add((row["mode"], int(row["game"])))
+        return finished
+
+    def open(self):
+        new_file = not os.path.isfile(self.filename) or \
+            os.path.getsize(self.filename) == 0
+        self.file = open(self.filename, "a", newline="")
+        if not self.jsonl:
+            self.csv_writer = csv.DictWriter(self.file, RESULT_FIELDS)
+            if new_file:
+                self.csv_writer.writeheader()
+
+    def write(self, results) -> None:
+        for result in results:
+            if self.jsonl:
+                self.file.write(json.dumps(result) + "\n")
+            else:
+                self.csv_writer.writerow(result)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def make_tasks(args, finished):
+    for mode in args.modes:
+        games = [game for game in range(args.games)
+                 if (mode, game) not in finished]
+        for i in range(0, len(games), args.chunk_size):
+            yield (mode, games[i:i + args.chunk_size], args.seed,
+                   args.policy, args.max_pieces)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Play seeded games headless across a process pool")
+    parser.add_argument("output", help="results file, .csv or .jsonl")
+    parser.add_argument("--games", type=int, default=100,
+                        help="games per mode")
+    parser.add_argument("--modes", nargs="+", choices=PIECE_TYPES,
+                        default=list(PIECE_TYPES))
+    parser.add_argument("--policy", default="random",
+                        help="builtin policy or module:function")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="game i is played with seed + i")
+    parser.add_argument("--max-pieces", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=4)
+    args = parser.parse_args()
+    load_policy(args.policy)
+    writer = ResultWriter(args.output)
+    finished = writer.load_finished()
+    writer.open()
+    done = 0
+    start = perf_counter()
+    try:
+        with Pool(args.workers) as pool:
+            for results in pool.imap_unordered(play_chunk,
+                                               make_tasks(args, finished)):
+                writer.write(results)
+                done += len(results)
+    finally:
+        writer.close()
+    elapsed = perf_counter() - start
+    print(f"{done} games in {elapsed:.2f} s "
+          f"({len(finished)} already finished)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import numpy as np
+
+from engine import SPAWN_COORDS
+
+# Walls, ceiling and floor are stored as set bits around the playfield so
+# every collision test is a single AND per piece row, without bound checks
+PAD = 8
+TOP = 8
+BOTTOM = 8
+BOX = 5
+
+NONE = 0
+LEFT = 1
+RIGHT = 2
+ROTATE_CW = 3
+ROTATE_CCW = 4
+SOFT_DROP = 5
+HARD_DROP = 6
+ACTIONS = (NONE, LEFT, RIGHT, ROTATE_CW, ROTATE_CCW, SOFT_DROP, HARD_DROP)
+
+# Indexed by cleared rows, same table as TetrisEngine.score_counter
+LINE_SCORES = np.array([0, 100, 300, 500, 800, 0], dtype=np.int64)
+LEVEL_LINES = np.array([0, 1, 3, 5, 8, 0], dtype=np.int64)
+
+
+def build_shape_tables(piece_type):
+    shapes = [shape for shape, _ in piece_type.SHAPES]
+    kicks_count = max(len(shape.get_kick_data(rot, (rot + turn) % 4))
+                      for shape in shapes
+                      for rot in range(4) for turn in (1, -1))
+    masks = np.zeros((len(shapes), 4, BOX), dtype=np.int64)
+    # kicks[shape, rotation, direction (0 = cw, 1 = ccw), kick] = (dx, dy)
+    kicks = np.zeros((len(shapes), 4, 2, kicks_count, 2), dtype=np.int64)
+    for index, shape in enumerate(shapes):
+        for rot in range(4):
+            for x, y in shape.calculate_rotation(rot):
+                masks[index, rot, y] |= 1 << x
+            for direction, turn in enumerate((1, -1)):
+                kick_data = shape.get_kick_data(rot, (rot + turn) % 4)
+                # Padding repeats the first kick, which never changes results
+                kick_data = kick_data + (kick_data[0],) * \
+                    (kicks_count - len(kick_data))
+                kicks[index, rot, direction] = kick_data
+    return masks, kicks
+
+
+class VectorEngine(object):
+    def __init__(self, piece_type, boards: int, width: int = 10,
+                 height: int = 40, seed=None):
+        # Save init params
+        self.piece_type = piece_type
+        self.boards = boards
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        # Precalculate masks and tables
+        self.masks, self.kicks = build_shape_tables(piece_type)
+        self.shapes_count = len(self.masks)
+        self.full_row = (1 << (width + 2 * PAD)) - 1
+        self.empty_row = self.full_row & ~(((1 << width) - 1) << PAD)
+        self.index = np.arange(boards)
+        self.box_rows = np.arange(BOX)
+        self.reset()
+
+    def reset(self) -> None:
+        rows = TOP + self.height + BOTTOM
+        self.board = np.full((self.boards, rows), self.full_row,
+                             dtype=np.int64)
+        self.board[:, TOP:TOP + self.height] = self.empty_row
+        self.piece = np.zeros(self.boards, dtype=np.int64)
+        self.rotation = np.zeros(self.boards, dtype=np.int64)
+        self.x = np.zeros(self.boards, dtype=np.int64)
+        self.y = np.zeros(self.boards, dtype=np.int64)
+        self.bag = np.zeros((self.boards, self.shapes_count), dtype=np.int64)
+        self.bag_pos = np.full(self.boards, self.shapes_count,
+                               dtype=np.int64)
+        self.next_piece = np.zeros(self.boards, dtype=np.int64)
+        self.score = np.zeros(self.boards, dtype=np.int64)
+        self.level = np.ones(self.boards, dtype=np.int64)
+        self.total_lines = np.zeros(self.boards, dtype=np.int64)
+        self.lines = np.zeros(self.boards, dtype=np.int64)
+        self.pieces = np.zeros(self.boards, dtype=np.int64)
+        self.game_over = np.zeros(self.boards, dtype=bool)
+        everything = np.ones(self.boards, dtype=bool)
+        self.next_piece[:] = self.draw_pieces(everything)
+        self.spawn(everything)
+
+    def reset_boards(self, mask) -> None:
+        # Restart finished games in place, keeping the others running
+        if not mask.any():
+            return
+        self.board[mask, TOP:TOP + self.height] = self.empty_row
+        self.score[mask] = 0
+        self.level[mask] = 1
+        self.total_lines[mask] = 0
+        self.lines[mask] = 0
+        self.pieces[mask] = 0
+        self.game_over[mask] = False
+        self.spawn(mask)
+
+    def draw_pieces(self, mask):
+        refill = mask & (self.bag_pos >= self.shapes_count)
+        if refill.any():
+            keys = self.rng.random((int(refill.sum()), self.shapes_count))
+            self.bag[refill] = np.argsort(keys, axis=1)
+            self.bag_pos[refill] = 0
+        pieces = self.bag[self.index, np.minimum(self.bag_pos,
+                                                 self.shapes_count - 1)]
+        self.bag_pos[mask] += 1
+        return pieces[mask]
+
+    def spawn(self, mask) -> None:
+        self.piece[mask] = self.next_piece[mask]
+        self.next_piece[mask] = self.draw_pieces(mask)
+        self.rotation[mask] = 0
+        self.x[mask] = SPAWN_COORDS[0]
+        self.y[mask] = SPAWN_COORDS[1]
+        index = np.flatnonzero(mask)
+        self.game_over[index] |= ~self.fits(index, self.rotation[index],
+                                            self.x[index], self.y[index])
+
+    def fits(self, index, rotation, x, y):
+        # Works on the boards in index only, so rare actions stay cheap
+        rows = self.board[index[:, None], y[:, None] + TOP + self.box_rows]
+        masks = self.masks[self.piece[index], rotation] << (x + PAD)[:, None]
+        return ~(rows & masks).any(axis=1)
+
+    def try_move(self, mask, dx: int, dy: int) -> None:
+        index = np.flatnonzero(mask)
+        ok = index[self.fits(index, self.rotation[index],
+                             self.x[index] + dx, self.y[index] + dy)]
+        self.x[ok] += dx
+        self.y[ok] += dy
+
+    def try_rotate(self, mask, direction: int) -> None:
+        index = np.flatnonzero(mask)
+        kicks = self.kicks[self.piece[index], self.rotation[index], direction]
+        new_rotation = (self.rotation[index] +
+                        (1 if direction == 0 else -1)) % 4
+        for kick in range(kicks.shape[1]):
+            if not len(index):
+                break
+            x = self.x[index] + kicks[:, kick, 0]
+            y = self.y[index] + kicks[:, kick, 1]
+            ok = self.fits(index, new_rotation, x, y)
+            self.x[index[ok]] = x[ok]
+            self.y[index[ok]] = y[ok]
+            self.rotation[index[ok]] = new_rotation[ok]
+            index = index[~ok]
+            kicks = kicks[~ok]
+            new_rotation = new_rotation[~ok]
+
+    def hard_drop(self, mask) -> None:
+        index = np.flatnonzero(mask)
+        while len(index):
+            index = index[self.fits(index, self.rotation[index],
+                                    self.x[index], self.y[index] + 1)]
+            self.y[index] += 1
+
+    def lock(self, mask) -> None:
+        index = np.flatnonzero(mask)
+        masks = self.masks[self.piece[index], self.rotation[index]] << \
+            (self.x[index] + PAD)[:, None]
+        rows = self.y[index][:, None] + TOP + self.box_rows
+        for dy in range(BOX):
+            self.board[index, rows[:, dy]] |= masks[:, dy]
+        self.pieces[index] += 1
+        self.clear_lines(mask)
+        self.spawn(mask)
+
+    def clear_lines(self, mask) -> None:
+        field = self.board[:, TOP:TOP + self.height]
+        full = (field == self.full_row) & mask[:, None]
+        cleared = full.sum(axis=1)
+        if cleared.any():
+            # Stable sort moves full rows to the top keeping the stack order
+            order = np.argsort(~full, axis=1, kind="stable")
+            field = np.take_along_axis(field, order, axis=1)
+            field[np.arange(self.height) < cleared[:, None]] = \
+                self.empty_row
+            self.board[:, TOP:TOP + self.height] = field
+        self.lines += cleared
+        cleared = np.minimum(cleared, len(LINE_SCORES) - 1)
+        self.score += LINE_SCORES[cleared] * self.level
+        self.total_lines += LEVEL_LINES[cleared]
+        level_up = self.total_lines >= self.level * 5
+        self.total_lines[level_up] = 0
+        self.level += level_up
+
+    def step(self, actions) -> None:
+        # Every step is one input and one row of gravity, pieces lock as
+        # soon as gravity is blocked, hard drops lock immediately
+        actions = np.asarray(actions)
+        active = ~self.game_over
+        self.try_move(active & (actions == LEFT), -1, 0)
+        self.try_move(active & (actions == RIGHT), 1, 0)
+        self.try_move(active & (actions == SOFT_DROP), 0, 1)
+        self.try_rotate(active & (actions == ROTATE_CW), 0)
+        self.try_rotate(active & (actions == ROTATE_CCW), 1)
+        self.hard_drop(active & (actions == HARD_DROP))
+        index = np.flatnonzero(active)
+        falling = self.fits(index, self.rotation[index],
+                            self.x[index], self.y[index] + 1)
+        self.y[index[falling]] += 1
+        locking = np.zeros(self.boards, dtype=bool)
+        locking[index[~falling]] = True
+        if locking.any():
+            self.lock(locking)
+
+    def random_actions(self):
+        return self.rng.integers(0, len(ACTIONS), self.boards)
+
+    def get_field(self):
+        # (boards, height, width) occupancy, same orientation as rows
+        field = self.board[:, TOP:TOP + self.height, None] >> \
+            (np.arange(self.width) + PAD)
+        return (field & 1).astype(bool)